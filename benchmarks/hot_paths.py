@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Timings and memory peaks of the hot paths of tzigane, over synthetic data
+served by a ParquetSource (see benchmarks/synthetic.py), written as JSON.
+
+    python benchmarks/hot_paths.py --duration 7D --output results.json
+"""
+# ===================================================================
+# Imports
+# ===================================================================
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import tzigane.util as util  # noqa: E402
+import tzigane.assessment as ass  # noqa: E402
+import tzigane.staves as stv  # noqa: E402
+from bokeh.models import ColumnDataSource  # noqa: E402
+from tzigane.inventory import INVENTORY  # noqa: E402
+from tzigane.pages import APPS  # noqa: E402
+from tzigane.sources import ParquetSource  # noqa: E402
+from tzigane.util import _qrange, sequence  # noqa: E402
+
+import synthetic  # noqa: E402
+
+ACCEL = 'accel_energy_512'
+ACTIVITY_CC = {'activity_producing': 'lightgreen',
+               'activity_idle': 'lightgrey',
+               'activity_operating': 'lightblue',
+               'activity_setup': 'lightyellow',
+               'activity_off': 'lightyellow'}
+
+# (name, set up) of the benchmarks: the set up gets the context and returns
+# the function to time.
+BENCHMARKS = []
+
+# ===================================================================
+# Helper function
+# ===================================================================
+
+
+def benchmark(name):
+    """Helper function that registers a benchmark."""
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+
+def thresholds(mac):
+    """Helper function that returns the thresholds of a synthetic device
+    (cf. tzigane.assessment.device_thresholds)."""
+    return {feature: ass.ADict(zip(ass.LEVELS, values))
+            for feature, values in synthetic.THRESHOLDS.items()}
+
+
+def measure(run, repeat):
+    """Helper function that times `repeat` runs, then measures the memory
+    peak of another one (tracemalloc slows it down)."""
+    times = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - started)
+    tracemalloc.start()
+    try:
+        run()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'repeat': repeat, 'min': min(times),
+            'median': float(np.median(times)), 'mean': float(np.mean(times)),
+            'peak_bytes': peak}
+
+
+@benchmark('_qrange')
+def _bench_qrange(ctx):
+    def run():
+        for i in range(1000):
+            _qrange(ctx.start, ctx.end)
+            _qrange(end=ctx.end, duration='1D')
+            _qrange(ctx.start, ctx.end, res='string')
+    return run
+
+
+def _bench_sequence(label, cold):
+    def setup(ctx):
+        def run():
+            if cold:
+                util.CACHE.clear()
+            sequence(ctx.mac, label, start=ctx.start, end=ctx.end)
+        return run
+    return setup
+
+
+for _label in [ACCEL, 'summary_1m', 'activity', 'MetricSummary30m']:
+    for _cold in [True, False]:
+        benchmark('sequence[{}, {}]'.format(
+            _label, 'cold' if _cold else 'warm'))(
+                _bench_sequence(_label, _cold))
+
+
+@benchmark('CycleStave._plot_fig')
+def _bench_cycle(ctx):
+    stave = stv.CycleStave('activity', mac=ctx.mac, start=ctx.start,
+                           end=ctx.end, lazy=True)
+    stave.data = stave._load()
+    return stave._plot_fig
+
+
+@benchmark('StackedPercentageStave._plot_fig')
+def _bench_stacked(ctx):
+    data = sequence(ctx.mac, 'MetricSummary5m', start=ctx.start, end=ctx.end)
+    stave = stv.StackedPercentageStave('activity', cc=ACTIVITY_CC, data=data,
+                                       score=ctx, mac=ctx.mac,
+                                       start=ctx.start, end=ctx.end,
+                                       lazy=True)
+    return stave._plot_fig
+
+
+def _bench_heatmap(bins):
+    def setup(ctx):
+        data = sequence(ctx.mac, 'MetricSummary5m', start=ctx.start,
+                        end=ctx.end)
+        stave = stv.HeatMapStave('production_count', data=data, score=ctx,
+                                 bins=bins, mac=ctx.mac, start=ctx.start,
+                                 end=ctx.end, lazy=True)
+        loaded = stave._load()
+        return lambda: stave._render(loaded)
+    return setup
+
+
+# The heatmaps are rendered by _render (CycleStave._plot_fig is not theirs)
+benchmark('HeatMapStave._render[table]')(_bench_heatmap(None))
+benchmark('HeatMapStave._render[1h]')(_bench_heatmap('1h'))
+
+
+@benchmark('FeatureSummaryStave._update_fig')
+def _bench_feature_summary(ctx):
+    score = SimpleNamespace(summary_range=SimpleNamespace(value='summary_5m'),
+                            _mac=SimpleNamespace(value=ctx.mac))
+    data = sequence(ctx.mac, 'summary_5m', start=ctx.start, end=ctx.end)
+    data_feat = sequence(ctx.mac, 'summary_1m', start=ctx.start, end=ctx.end)
+    stave = stv.FeatureSummaryStave(ACCEL, data=data, data_feat=data_feat,
+                                    score=score, mac=ctx.mac,
+                                    start=ctx.start, end=ctx.end, lazy=True)
+    return stave._update_fig
+
+
+def _condition_stave(ctx):
+    source = ColumnDataSource({'index': ass.LEVELS,
+                               ACCEL: synthetic.THRESHOLDS[ACCEL]})
+    stave = stv.ConditionStave(ACCEL, source, mac=ctx.mac,
+                               start=ctx.start, end=ctx.end, lazy=True)
+    stave._render(stave._load())
+    stave._update_gadgets()
+    return stave
+
+
+@benchmark('Stave._update_gadgets')
+def _bench_gadgets(ctx):
+    return _condition_stave(ctx)._update_gadgets
+
+
+@benchmark('pFunction slider')
+def _bench_slider(ctx):
+    slider = _condition_stave(ctx).gadgets[0].slider
+    values = np.linspace(slider.start, slider.end, 20)
+
+    def run():
+        # Out of a session, the slider callbacks run right away
+        for value in values:
+            slider.value = float(value)
+    return run
+
+
+@benchmark('Score.update_staves')
+def _bench_score(ctx):
+    score = APPS['batch']('batch')
+    score()
+    # Out of a session, the staves are built right away (or the failure is
+    # logged)
+    assert score.staves, "the score has no staves"
+
+    def run():
+        util.CACHE.clear()
+        score.update_staves({'time_range': (ctx.start, ctx.end)})
+    return run
+
+
+def run_all(ctx, repeat, names=None):
+    """Helper function that runs the benchmarks (all of them by default)."""
+    results = []
+    for name, setup in BENCHMARKS:
+        if names and name not in names:
+            continue
+        res = {'name': name, 'error': None}
+        try:
+            util.CACHE.clear()
+            res.update(measure(setup(ctx), repeat))
+        except Exception as e:
+            res['error'] = repr(e)
+        results.append(res)
+        print("{name}: {res}".format(name=name, res=res), file=sys.stderr)
+    return results
+
+
+# ===================================================================
+# Main
+# ===================================================================
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('names', nargs='*',
+                        help="benchmarks to run (all of them by default)")
+    parser.add_argument('--parquet', help="directory of the synthetic data "
+                        "(generated in a temporary directory by default)")
+    parser.add_argument('--end', default='2017-10-02')
+    parser.add_argument('--duration', default='1D')
+    parser.add_argument('--rate', default='1s')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help="JSON file (stdout by default)")
+    args = parser.parse_args()
+
+    end = pd.Timestamp(args.end, tz='utc')
+    start = end - pd.Timedelta(args.duration)
+    root = args.parquet or tempfile.mkdtemp(prefix='tzigane-bench-')
+    try:
+        if not os.path.exists(os.path.join(root, 'inventory.json')):
+            started = time.perf_counter()
+            synthetic.generate(root, start, end, args.rate)
+            elapsed = time.perf_counter() - started
+            print("Generated in {:.1f}s".format(elapsed), file=sys.stderr)
+        util.set_source(ParquetSource(root))
+        util.set_now(end)
+        # The synthetic devices are not known to dataforge
+        ass.device_thresholds = thresholds
+        INVENTORY.update(util.SOURCE.devices(), save=False)
+        ctx = SimpleNamespace(mac=synthetic.MAC, start=start, end=end)
+        results = run_all(ctx, args.repeat, args.names)
+    finally:
+        if not args.parquet:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = {'params': {'end': str(end), 'duration': args.duration,
+                         'rate': args.rate, 'repeat': args.repeat},
+              'python': platform.python_version(),
+              'pandas': pd.__version__,
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
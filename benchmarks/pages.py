@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Opens the pages of tzigane.pages.APPS headlessly (out of any bokeh session,
+so that the staves are loaded synchronously) and prints, as JSON lines, the
+time taken to open each of them and to refresh it.
+
+Record the backend queries, then replay them (with their latency):
+    python benchmarks/pages.py --record /tmp/tzigane-archive
+    python benchmarks/pages.py --replay /tmp/tzigane-archive --latency 1
+"""
+# ===================================================================
+# Imports
+# ===================================================================
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import tzigane.util as util  # noqa: E402
+from tzigane.inventory import INVENTORY  # noqa: E402
+from tzigane.pages import APPS  # noqa: E402
+from tzigane.sources import ParquetSource  # noqa: E402
+from tzigane.sources import RecordingSource, ReplaySource  # noqa: E402
+
+# ===================================================================
+# Helper function
+# ===================================================================
+
+
+def set_up(args):
+    """Helper function that sets the backend, pinned time and inventory."""
+    if args.replay:
+        source = ReplaySource(args.replay, args.latency)
+        util.set_now(args.now or source.now)
+    else:
+        util.set_now(args.now or pd.Timestamp('now', tz='utc').floor('s'))
+        source = ParquetSource(args.parquet) if args.parquet \
+            else util.SOURCE
+        if args.record:
+            source = RecordingSource(source, args.record, now=util.NOW)
+    util.set_source(source)
+    INVENTORY.update(util.SOURCE.devices(), save=False)
+
+
+def open_page(title, repeat=3, cold=False, seed=0):
+    """Helper function that opens a page, then refreshes it `repeat` times
+    (with an empty cache if cold), and returns the timings (in seconds)."""
+    random.seed(seed)
+    util.CACHE.clear()
+    res = {'page': title, 'open': None, 'refresh': [], 'error': None}
+    try:
+        started = time.time()
+        score = APPS[title](title)
+        score()
+        res['open'] = time.time() - started
+        for i in range(repeat):
+            if cold:
+                util.CACHE.clear()
+            started = time.time()
+            score.refresh_range('submit')
+            res['refresh'].append(time.time() - started)
+        score.close()
+    except Exception as e:
+        res['error'] = repr(e)
+    res['cache'] = util.CACHE.stats()
+    return res
+
+
+# ===================================================================
+# Main
+# ===================================================================
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('pages', nargs='*', default=sorted(APPS),
+                        help="pages to open (all of them by default)")
+    parser.add_argument('--record', help="archive to record the queries to")
+    parser.add_argument('--replay', help="archive to replay")
+    parser.add_argument('--latency', type=float, default=0.,
+                        help="factor of the replayed latencies")
+    parser.add_argument('--parquet', help="directory of Parquet files to "
+                        "serve instead of the backend")
+    parser.add_argument('--now', help="pinned current time")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--cold', action='store_true',
+                        help="clear the cache before every refresh")
+    args = parser.parse_args()
+    set_up(args)
+    for title in args.pages:
+        print(json.dumps(open_page(title, args.repeat, args.cold)),
+              flush=True)
+
+
+if __name__ == '__main__':
+    main()
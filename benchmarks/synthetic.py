@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic device data: raw features, feature and metric summaries, state
+transition logs and stroke logs, written in the layout of
+tzigane.sources.ParquetSource.
+
+    python benchmarks/synthetic.py /tmp/tzigane-data --duration 7D
+"""
+# ===================================================================
+# Imports
+# ===================================================================
+
+import os
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from tzigane.sources import ParquetSource  # noqa: E402
+from tzigane.util import FEATURE_PERIODS, METRIC_PERIODS  # noqa: E402
+
+# The device of the press production scores, and a vibrations device.
+MAC = '88:4A:EA:69:E1:59'
+VIBRATIONS_MAC = '88:4A:EA:69:36:F5'
+FEATURES = ['accel_energy_512', 'velocity_x', 'velocity_y', 'velocity_z']
+STATES = {'activity': ['producing', 'idle', 'operating', 'setup', 'off'],
+          'condition': ['idle', 'operating', 'warning', 'critical'],
+          'connectivity': ['connected', 'disconnected'],
+          'pressprod': ['producing', 'idle']}
+# Mean time spent in a state.
+STATE_DURATION = {'activity': '30min', 'condition': '2h',
+                  'connectivity': '12h', 'pressprod': '10min'}
+# Thresholds (high, med, low) of the features of the synthetic devices,
+# which are not known to dataforge.
+THRESHOLDS = {feature: [90., 70., 50.] for feature in FEATURES}
+
+# ===================================================================
+# Helper function
+# ===================================================================
+
+
+def features(start, end, rate='1s', seed=0):
+    """Helper function that returns the raw features sampled at rate: a
+    daily cycle, a random walk and gamma noise."""
+    rng = np.random.RandomState(seed)
+    index = pd.date_range(start, end, freq=rate, name='timestamp')
+    seconds = (index - index[0]).total_seconds().values
+    base = 50 + 20 * np.sin(2 * np.pi * seconds / 86400)
+    walk = np.cumsum(rng.normal(0, 0.05, len(index)))
+    return pd.DataFrame({f: (1 + 0.2 * i) * base + walk +
+                         rng.gamma(2., 2. + i, len(index))
+                         for i, f in enumerate(FEATURES)}, index=index)
+
+
+def summary(df, period):
+    """Helper function that returns the min/mean/max of the columns over
+    rows of the period (cf. the summary tables)."""
+    rows = df.resample(period)
+    res = pd.concat([rows.min().add_suffix('_min'),
+                     rows.mean().add_suffix('_mean'),
+                     rows.max().add_suffix('_max')], axis=1)
+    return res.dropna(how='all')
+
+
+def transitions(start, end, states, duration='30min', seed=0):
+    """Helper function that returns a transition log (the 'state' entered
+    at each timestamp), the states lasting `duration` on average."""
+    rng = np.random.RandomState(seed)
+    mean = pd.Timedelta(duration).total_seconds()
+    n = int((end - start).total_seconds() / mean * 2) + 2
+    offsets = np.r_[0, np.cumsum(rng.exponential(mean, n - 1))]
+    index = start + pd.to_timedelta(offsets, unit='s')
+    index = index[index < end]
+    # Consecutive states differ
+    steps = 1 + rng.randint(0, len(states) - 1, len(index))
+    codes = (rng.randint(len(states)) + np.cumsum(steps)) % len(states)
+    return pd.DataFrame({'state': np.asarray(states)[codes]},
+                        index=pd.DatetimeIndex(index, name='timestamp'))
+
+
+def strokes(start, end, rate='2s', seed=0):
+    """Helper function that returns a stroke log, as a Poisson process."""
+    rng = np.random.RandomState(seed)
+    mean = pd.Timedelta(rate).total_seconds()
+    n = int((end - start).total_seconds() / mean * 1.2) + 1
+    index = start + pd.to_timedelta(np.cumsum(rng.exponential(mean, n)),
+                                    unit='s')
+    index = index[index < end]
+    return pd.DataFrame({'stroke': np.ones(len(index), dtype='int64')},
+                        index=pd.DatetimeIndex(index, name='timestamp'))
+
+
+def time_in_states(log, name, start, end, period):
+    """Helper function that returns the percentage of each period spent in
+    the states of a log (columns '<name>_<state>', cf. the metric
+    summaries), sampled every minute."""
+    grid = pd.date_range(start, end, freq='1min')
+    grid = grid[grid < end]
+    pos = np.searchsorted(log.index.values, grid.values, side='right') - 1
+    states = np.where(pos >= 0, log['state'].values[np.clip(pos, 0, None)],
+                      'na')
+    onehot = pd.get_dummies(pd.Series(states, index=grid)).astype('float64')
+    onehot.columns = ['{}_{}'.format(name, c) for c in onehot.columns]
+    return 100 * onehot.resample(period).mean()
+
+
+def generate(root, start, end, rate='1s', stroke_rate='2s', seed=0):
+    """Helper function that writes the data of the synthetic devices to
+    root and returns the ParquetSource reading it."""
+    source = ParquetSource(root)
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    records = []
+    for i, (mac, function) in enumerate([(MAC, 'pressprod'),
+                                         (VIBRATIONS_MAC, 'vibrations')]):
+        raw = features(start, end, rate, seed=seed + i)
+        for feature in FEATURES:
+            source.write(mac, feature, raw[[feature]])
+        for label, period in FEATURE_PERIODS:
+            source.write(mac, label, summary(raw, period))
+        logs = {name: transitions(start, end, states,
+                                  STATE_DURATION[name], seed=seed + i)
+                for name, states in STATES.items()}
+        for name, log in logs.items():
+            source.write(mac, name, log)
+        stroke = strokes(start, end, stroke_rate, seed=seed + i)
+        source.write(mac, 'stroke', stroke)
+        for label, period in METRIC_PERIODS:
+            metrics = [time_in_states(logs[name], name, start, end, period)
+                       for name in ['activity', 'condition', 'connectivity']]
+            counts = stroke['stroke'].resample(period).sum()
+            metrics.append(counts.rename('production_count').to_frame())
+            source.write(mac, label, pd.concat(metrics, axis=1).fillna(0))
+        records.append({'mac': mac, 'device': 'synthetic {}'.format(function),
+                        'account': 'synthetic', 'function': function})
+    source.write_devices(records)
+    return source
+
+
+# ===================================================================
+# Main
+# ===================================================================
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('root', help="directory of the Parquet files")
+    parser.add_argument('--end', default='2017-10-02')
+    parser.add_argument('--duration', default='1D')
+    parser.add_argument('--rate', default='1s',
+                        help="sampling period of the raw features")
+    parser.add_argument('--stroke-rate', default='2s',
+                        help="mean time between two strokes")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    end = pd.Timestamp(args.end, tz='utc')
+    generate(args.root, end - pd.Timedelta(args.duration), end, args.rate,
+             args.stroke_rate, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,22 +22,24 @@ Please run:
 # ===================================================================
 
 import os
-from threading import Thread
-from flask import Flask, render_template
+import json
+from concurrent.futures import as_completed
+from flask import Flask, Response, abort, render_template, request
+from flask import send_from_directory
 
 # Make sure you have run 'pip install bokeh==0.12.9'
 from bokeh.embed import server_document
-from bokeh.server.server import BaseServer
-from bokeh.server.tornado import BokehTornado
-from bokeh.server.util import bind_sockets
-
-from tornado.httpserver import HTTPServer
-from tornado.ioloop import IOLoop
 
 import anaximander as nx
 from tzigane import LOGGER
+import tzigane.fleet as fl
+import tzigane.metrics as mtr
 import tzigane.pages as tpg
-from tzigane.scores import load_accounts
+import tzigane.profiling as prf
+from tzigane.inventory import load_accounts
+from tzigane.scores import get_feature_range_from
+from tzigane.server import ScoreServer
+from tzigane.util import CACHE, _qrange
 
 import webbrowser
 import warnings
@@ -47,7 +49,10 @@ path = 'prod-ac1c3416cbdd.json'
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = path
 app = Flask(__name__)
 PORT = 8000
+BOKEH_PORT = int(os.environ.get('TZIGANE_BOKEH_PORT', 5006))
 LOCAL = nx.LOCAL
+# Arguments of the pages passed to the sessions of the scores.
+FLAGS = ['debug', 'profile']
 
 
 # ===================================================================
@@ -64,58 +69,84 @@ def index():
 @app.route('/score/<score_title>', methods=['GET'])
 def base(score_title):
     LOGGER.info("you're on {}".format(score_title))
-    url = '/' + score_title
-    score = APPS[score_title](score_title)
-    LOGGER.info("starting score...")
-    score()
-    LOGGER.info("starting server...")
-    bokeh_tornado = BokehTornado({url: score.app},
-                                 extra_websocket_origins=["localhost:8000"])
-#                                 extra_websocket_origins=["52.53.126.244:8000"])
-    # A non-blocking, single-threaded HTTP server (from Tornado)
-    bokeh_http = HTTPServer(bokeh_tornado)
-
-    # If port is 0, the OS automatically chooses a free port
-    # sockets will listen to localhost
-    # Opens a new process (visible with netstat) on the port
-    sockets, port = bind_sockets('127.0.0.1', 0)
-#    sockets, port = bind_sockets('0.0.0.0', 0)    
-    bokeh_http.add_sockets(sockets)
-    LOGGER.info("sockets, port: {}, {}".format(sockets, port))
-
-    def bk_worker():
-        # An Input/Output event loop for non-blocking sockets (from tornado)
-        io_loop = IOLoop.instance()
-        # Explicitly coordinate the level Tornado components
-        # required to run a Bokeh server:
-        #    - IOLoop to run the Bokeh server machinery.
-        #    - Tornado application that defines the Bokeh server machinery.
-        #    - HTTPServer to direct HTTP requests
-        server = BaseServer(io_loop, bokeh_tornado, bokeh_http)
-        server.start()
-        server.io_loop.start()
-
-    LOGGER.info("starting thread...")
-    Thread(target=bk_worker).start()
-    script = server_document('http://localhost:{}{}'.format(port, url))
-#    script = server_document('http://52.53.126.244:{}{}'.format(port, url))
+    if score_title not in SERVER:
+        abort(404)
+    # The score itself is created by the bokeh server, for every session
+    # (the flags, e.g. ?debug=1, are passed to it)
+    arguments = {k: v for k, v in request.args.items() if k in FLAGS}
+    script = server_document(SERVER.url(score_title), arguments=arguments)
+#    script = server_document(SERVER.url(score_title, '52.53.126.244'))
     return render_template("base.html", script=script, title=score_title)
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Metrics of the process, in the Prometheus text format."""
+    gauges = {'cache_' + k: v for k, v in CACHE.stats().items()}
+    gauges['sessions'] = len(SERVER.sessions)
+    return Response(mtr.REGISTRY.prometheus(gauges),
+                    mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/profiles', methods=['GET'])
+def profiles():
+    """Latest profiles of the callbacks (see tzigane.profiling)."""
+    return render_template("profiles.html", profiles=prf.index(),
+                           title="Profiles")
+
+
+@app.route('/profiles/<name>', methods=['GET'])
+def profile(name):
+    """Statistics of a profile (?download=1 for the pstats file)."""
+    if request.args.get('download'):
+        return send_from_directory(prf.PROFILE_DIR, name, as_attachment=True)
+    sort = request.args.get('sort')
+    text = prf.report(name, sort=sort if sort in prf.SORTS else prf.SORTS[0])
+    if text is None:
+        abort(404)
+    return Response(text, mimetype='text/plain')
+
+
+@app.route('/api/fleet/<function>', methods=['GET'])
+def fleet_scan(function):
+    """Scan of the devices of a function (see tzigane.fleet), streamed as
+    one JSON line per device, in the order they complete.
+    Parameters: label (by default, the summary giving enough rows over the
+    range, as in the fleet score), start, end, duration."""
+    start, end = _qrange(request.args.get('start'), request.args.get('end'),
+                         duration=request.args.get('duration'))
+    label = request.args.get('label') or get_feature_range_from(start, end)
+    futures = fl.scan(label, start, end, function)
+
+    def results():
+        try:
+            for future in as_completed(futures):
+                yield json.dumps(fl.to_json(future.result()),
+                                 default=str) + '\n'
+        finally:
+            # Once done, or when the client went away
+            for future in futures:
+                future.cancel()
+
+    return Response(results(), mimetype='application/x-ndjson')
+
+
 # ===================================================================
 # Main
 # ===================================================================
 
 
-APPS = {'batch': tpg.PressProdBatchScore,
-        'streaming': tpg.PressProdStreamingScore,
-        'condition': tpg.ConditionBatchScore,
-        'feature_summary': tpg.FeatureSummaryBatchScore,
-        'metric_summary': tpg.MetricSummaryBatchScore}
+APPS = tpg.APPS
+
+# A single bokeh server hosts all the scores.
+SERVER = ScoreServer(APPS, port=BOKEH_PORT)
+# SERVER = ScoreServer(APPS, port=BOKEH_PORT, address='0.0.0.0',
+#                      origins=["52.53.126.244:8000"])
 
 
 if __name__ == '__main__':
     webbrowser.open_new("http://localhost:8000")
     load_accounts()
+    SERVER.start()
     app.run(host='localhost', port=8000)
 #    app.run(host='0.0.0.0', port=8000)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Multi-process deployment of the scores of main.py, e.g.:
+
+    gunicorn -w 4 -b localhost:8000 main_gunicorn:app
+
+Every gunicorn worker runs its own bokeh server on its own port (as in
+flask_gunicorn_embed.py): the page served by a worker embeds the port of
+this worker, so that the session sticks to the process which served it.
+The workers share the frames they fetch through the on-disk tier of the
+cache, kept in shared memory (/dev/shm) unless TZIGANE_CACHE_DIR is set.
+Do not use --preload: the bokeh servers must be started after the fork.
+"""
+# ===================================================================
+# Imports
+# ===================================================================
+
+import os
+import tempfile
+
+if __name__ == '__main__':
+    print('This script is intended to be run with gunicorn. e.g.')
+    print()
+    print('    gunicorn -w 4 -b localhost:8000 main_gunicorn:app')
+    print()
+    print('will start the app on four processes')
+    import sys
+    sys.exit()
+
+# This has to be set before tzigane is imported
+SHM = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+os.environ.setdefault('TZIGANE_CACHE_DIR', os.path.join(SHM, 'tzigane'))
+# Each worker binds its own port
+os.environ.setdefault('TZIGANE_BOKEH_PORT', '0')
+
+from tzigane import LOGGER  # noqa: E402
+from tzigane.inventory import load_accounts  # noqa: E402
+from main import app, SERVER  # noqa: F401,E402
+
+# ===================================================================
+# Worker
+# ===================================================================
+
+
+load_accounts()
+SERVER.start()
+LOGGER.info("Worker {} serves the scores on port {}".format(os.getpid(),
+                                                            SERVER.port))
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests of the tiled cache of tzigane.util.sequence.
+"""
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('dataforge')
+
+import tzigane.util as util  # noqa: E402
+from tzigane.sources import ParquetSource  # noqa: E402
+
+MAC = '88:4A:EA:69:E1:59'
+DAY = pd.Timestamp('2017-10-01', tz='utc')
+
+
+@pytest.fixture
+def source(tmpdir):
+    """Activity log of a device: idle at 00:00, producing at 01:00."""
+    source = ParquetSource(str(tmpdir))
+    log = pd.DataFrame({'state': ['idle', 'producing']},
+                       index=[DAY, DAY + pd.Timedelta('1h')])
+    source.write(MAC, 'activity', log)
+    previous = util.SOURCE
+    util.set_source(source)
+    yield source
+    util.set_source(previous)
+
+
+def _states(start, end, cache=True):
+    frame = util.sequence(MAC, 'activity', start=DAY + pd.Timedelta(start),
+                          end=DAY + pd.Timedelta(end), cache=cache)
+    return frame.as_digest().shades()
+
+
+def test_state_without_transition_in_window(source):
+    # The state entered before the window lasts over it
+    assert _states('2h', '3h') == _states('2h', '3h', cache=False) == \
+        ['producing']
+
+
+def test_state_in_effect_at_start_of_window(source):
+    assert _states('30min', '3h') == _states('30min', '3h', cache=False) \
+        == ['idle', 'producing']
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Condition assessments run in the background, memoized by (mac, range,
+thresholds) and shared by the sessions asking for the same one, and sweeps
+of the thresholds over the series already loaded.
+"""
+# ===================================================================
+# Imports
+# ===================================================================
+
+import os
+import copy
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import product
+from threading import RLock
+
+import numpy as np
+import pandas as pd
+
+import dataforge.condition as cnd
+import dataforge.environment as env
+
+from tzigane.sampling import _ns
+from tzigane.util import LRUCache
+
+LEVELS = ['high', 'med', 'low']
+# States of the features, from below the low threshold to above the high one
+STATES = ['idle', 'operating', 'warning', 'critical']
+# Factors applied to the thresholds of each feature by the sweeps.
+SWEEP_FACTORS = [0.8, 0.9, 1.0, 1.1, 1.2]
+# Number of timestamps evaluated at once by the sweeps.
+SWEEP_CHUNK = 4096
+# Number of assessments kept in memory.
+ASSESSMENT_CACHE = int(os.environ.get('TZIGANE_ASSESSMENT_CACHE', 64))
+# Number of assessments run at once (of all the sessions), apart from the
+# stave loads of WORKERS.
+ASSESSMENT_CONCURRENCY = int(os.environ.get('TZIGANE_ASSESSMENT_CONCURRENCY',
+                                            2))
+ASSESSMENT_WORKERS = ThreadPoolExecutor(ASSESSMENT_CONCURRENCY)
+
+ASSESSMENTS = LRUCache(ASSESSMENT_CACHE)
+# Pending assessments: key -> (future, owners waiting for it)
+_PENDING = {}
+# Reentrant: cancelling a future runs its callbacks (_done) right away.
+_LOCK = RLock()
+
+# ===================================================================
+# Class definitions
+# ===================================================================
+
+
+class ADict(dict):
+    def __init__(self, *args, **kwargs):
+        super(ADict, self).__init__(*args, **kwargs)
+        self.__dict__ = self
+
+
+# ===================================================================
+# Helper function
+# ===================================================================
+
+
+def key_for(mac, start, end, thresholds):
+    """Helper function that returns the key of an assessment, thresholds
+    being {feature: [high, med, low]}."""
+    return (mac, start, end, tuple(sorted((feat, tuple(values))
+                                          for feat, values in
+                                          thresholds.items())))
+
+
+def device_thresholds(mac):
+    """Helper function that returns a copy of the thresholds of a device.
+    """
+    return dict(env.Device[mac].specs['thresholds'])
+
+
+def _what_if(mac, thresholds):
+    """Helper function that returns a copy of a device with the given
+    thresholds ((feature, [high, med, low]) pairs), the device itself being
+    shared by the sessions (and the fleet scans)."""
+    dev = copy.copy(env.Device[mac])
+    specs = dict(dev.specs)
+    specs['thresholds'] = dict(specs['thresholds'])
+    specs['thresholds'].update({feat: ADict(zip(LEVELS, values))
+                                for feat, values in thresholds})
+    dev.specs = specs
+    return dev
+
+
+def _assess(key):
+    mac, start, end, thresholds = key
+    dev = _what_if(mac, thresholds)
+    res = cnd.VibrationsConditionAssessment(dev, start, end)()
+    ASSESSMENTS.put(key, res)
+    return res
+
+
+def _done(key, future):
+    with _LOCK:
+        if _PENDING.get(key, (None,))[0] is future:
+            del _PENDING[key]
+
+
+def submit(key, owner):
+    """Future of the assessment of key, run on ASSESSMENT_WORKERS unless it
+    is memoized or already pending (for another owner)."""
+    res = ASSESSMENTS.get(key)
+    if res is not None:
+        future = Future()
+        future.set_result(res)
+        return future
+    with _LOCK:
+        future, owners = _PENDING.get(key, (None, set()))
+        if future is None:
+            future = ASSESSMENT_WORKERS.submit(_assess, key)
+            _PENDING[key] = (future, owners)
+        owners.add(owner)
+    future.add_done_callback(lambda f: _done(key, f))
+    return future
+
+
+def release(key, owner):
+    """The owner no longer waits for the assessment of key, which is
+    cancelled if nobody else does and it has not started yet."""
+    with _LOCK:
+        future, owners = _PENDING.get(key, (None, set()))
+        owners.discard(owner)
+        if future is not None and not owners:
+            future.cancel()
+
+
+def _levels(values, thresholds, factors):
+    """Helper function that returns the (factors x time) levels of the
+    values: 0 below the lowest of the scaled thresholds, up to 3 above the
+    highest one (NaNs are at 0)."""
+    scaled = np.outer(factors, sorted(thresholds))
+    return (values[None, :, None] >= scaled[:, None, :]).sum(axis=2) \
+        .astype('int8')
+
+
+def sweep(series, thresholds, factors=SWEEP_FACTORS, chunk=SWEEP_CHUNK):
+    """Helper function that evaluates every combination of the thresholds of
+    the features scaled by the factors: percentage of the time spent in each
+    state and number of transitions. series ({feature: Series}) are aligned
+    on the index of the first one, whose sampling gives the durations. The
+    state of a combination is the worst state of its features."""
+    feats = list(series)
+    grid = _ns(series[feats[0]].index)
+    if len(grid) < 2:
+        return pd.DataFrame(columns=feats + STATES + ['transitions'])
+    levels = []
+    for feat in feats:
+        x = _ns(series[feat].index)
+        y = np.asarray(series[feat].values, dtype='float64')
+        pos = np.searchsorted(x, grid, side='right') - 1
+        values = np.where(pos >= 0, y[np.clip(pos, 0, None)], np.nan)
+        levels.append(_levels(values, thresholds[feat], factors))
+    weights = np.diff(grid).astype('float64')
+    weights = np.r_[weights, np.median(weights)]
+    combos = np.array(list(product(range(len(factors)), repeat=len(feats))))
+    time_in = np.zeros((len(combos), len(STATES)))
+    transitions = np.zeros(len(combos), dtype='int64')
+    last = None
+    for i in range(0, len(grid), chunk):
+        state = levels[0][combos[:, 0], i:i + chunk]
+        for j in range(1, len(feats)):
+            state = np.maximum(state, levels[j][combos[:, j], i:i + chunk])
+        w = weights[i:i + chunk]
+        for s in range(len(STATES)):
+            time_in[:, s] += (state == s) @ w
+        transitions += (state[:, 1:] != state[:, :-1]).sum(axis=1)
+        if last is not None:
+            transitions += state[:, 0] != last
+        last = state[:, -1]
+    res = pd.DataFrame(np.asarray(factors)[combos], columns=feats)
+    for s, state in enumerate(STATES):
+        res[state] = 100 * time_in[:, s] / weights.sum()
+    res['transitions'] = transitions
+    return res
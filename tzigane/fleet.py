@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Scan of the devices of a function against their thresholds, over a summary
+table, with a bounded number of concurrent queries.
+"""
+# ===================================================================
+# Imports
+# ===================================================================
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from tzigane.assessment import device_thresholds
+from tzigane.inventory import INVENTORY
+from tzigane.util import sequence
+
+# Number of devices queried at once by the scans (of all the sessions).
+FLEET_CONCURRENCY = int(os.environ.get('TZIGANE_FLEET_CONCURRENCY', 4))
+FLEET_WORKERS = ThreadPoolExecutor(FLEET_CONCURRENCY)
+
+COLUMNS = ['mac', 'device', 'account', 'feature', 'peak', 'high', 'ratio',
+           'above_high', 'above_med', 'hours', 'error']
+NUMERIC = ['peak', 'high', 'ratio', 'above_high', 'above_med', 'hours']
+
+# ===================================================================
+# Helper function
+# ===================================================================
+
+
+def exceedances(df, thresholds):
+    """Helper function that returns, for every feature of thresholds
+    ({feature: (high, med)}) found in the frame, its peak and the
+    percentages of the time spent above its high and med thresholds. The
+    `_max` column of a summary is used when there is one. Every row lasts
+    until the next one (the last one as long as the one before)."""
+    feats = [f for f in thresholds
+             if f + '_max' in df.columns or f in df.columns]
+    res = pd.DataFrame(index=feats, columns=['peak', 'high', 'med',
+                                             'above_high', 'above_med'],
+                       dtype='float64')
+    if not feats or len(df) < 2:
+        return res
+    values = np.column_stack([
+        df[f + '_max' if f + '_max' in df.columns else f].values
+        for f in feats]).astype('float64')
+    ts = df.index.values.astype('datetime64[ns]').astype('int64')
+    weights = np.diff(ts).astype('float64')
+    weights = np.r_[weights, weights[-1]]
+    total = weights.sum()
+    high, med = np.array([thresholds[f] for f in feats], dtype='float64').T
+    res['high'], res['med'] = high, med
+    with np.errstate(invalid='ignore'):
+        res['peak'] = np.nanmax(values, axis=0)
+        res['above_high'] = 100 * (values >= high).T @ weights / total
+        res['above_med'] = 100 * (values >= med).T @ weights / total
+    return res
+
+
+def scan_device(record, label, start, end):
+    """Helper function that scans a device (a record of the inventory) and
+    returns its worst feature, i.e. the one whose peak is the highest
+    relatively to its high threshold."""
+    res = dict(record, feature=None, peak=np.nan, high=np.nan,
+               ratio=np.nan, above_high=np.nan, above_med=np.nan,
+               hours=0., error='')
+    try:
+        th = device_thresholds(record['mac'])
+        thresholds = {f: (v.high, v.med) for f, v in th.items()}
+        frame = sequence(record['mac'], label, start=start, end=end)
+        df = frame.data
+        ex = exceedances(df, thresholds)
+    except Exception as e:
+        res['error'] = str(e)
+        return res
+    if len(df) > 1:
+        res['hours'] = (df.index[-1] - df.index[0]) / pd.Timedelta(1, 'h')
+    ex['ratio'] = ex['peak'] / ex['high']
+    ex = ex.dropna(subset=['ratio'])
+    if not ex.empty:
+        worst = ex['ratio'].idxmax()
+        res.update(ex.loc[worst, ['peak', 'high', 'ratio', 'above_high',
+                                  'above_med']].to_dict(), feature=worst)
+    return res
+
+
+def scan(label, start, end, function='vibrations'):
+    """Helper function that submits the scan of every device of the function
+    and returns the futures of their results (see scan_device)."""
+    return [FLEET_WORKERS.submit(scan_device, record, label, start, end)
+            for record in INVENTORY.devices(function)]
+
+
+def rank(results):
+    """Helper function that sorts the results of a scan: the longest time
+    above the high threshold first, then the highest peak ratio."""
+    df = pd.DataFrame(list(results), columns=COLUMNS)
+    return df.sort_values(['above_high', 'ratio', 'above_med'],
+                          ascending=False, na_position='last') \
+        .reset_index(drop=True)
+
+
+def to_json(res):
+    """Helper function that replaces the NaNs of a result by None."""
+    return {k: None if isinstance(v, float) and np.isnan(v) else v
+            for k, v in res.items()}
@@ -7,21 +7,16 @@ The basic classes are defined in this file.
 # Imports
 # ===================================================================
 
+import numpy as np
 from bokeh.models import Line, ColumnDataSource
 from bokeh.layouts import layout
 from bokeh.application import Application
 from bokeh.application.handlers import FunctionHandler
 
-ACCEL = 'accel_energy_512'
-
-# ===================================================================
-# Helper function
-# ===================================================================
-
-
-def remove_fig(name, fig):
-    fig.renderers = list(filter(lambda x: x.name != name, fig.renderers))
+from tzigane.intervals import Exceedances
+from tzigane.util import Debounce
 
+ACCEL = 'accel_energy_512'
 
 # ===================================================================
 # Class definitions
@@ -41,7 +36,9 @@ class Base:
 
 
 class Gadget(Base):
-    """Base class for the gadgets. Every gadget is linked with a stave."""
+    """Base class for the gadgets. Every gadget is linked with a stave.
+    Gadgets are shown again on every update of the stave: they add their
+    renderers and tools once, then only update their sources."""
     def __init__(self, stave, name, *args, **kwargs):
         super().__init__()
         self.stave, self.name = stave, name
@@ -52,14 +49,20 @@ class Gadget(Base):
 
     def _show(self, *args, **kwargs):
         """Plot the gadget in the stave.fig and add the tool to stave.tools."""
-        if self.tool is not None:
-            self.stave.tools.children.append(self.tool)
+        self._add_tool(self.tool)
+
+    def _add_tool(self, tool):
+        """Add a widget to stave.tools, unless it is already there."""
+        children = self.stave.tools.children
+        if tool is not None and not any(el is tool for el in children):
+            children.append(tool)
 
 
 class hLine(Gadget):
     def __init__(self, stave, name, value, *args, **kwargs):
         super().__init__(stave, name)
         self.value = value
+        self.start, self.end = stave.start, stave.end
         self.color = kwargs.setdefault('color', 'green')
         self.width = kwargs.setdefault('width', 1)
         self.dash = kwargs.setdefault('dash', 'solid')
@@ -69,6 +72,7 @@ class hLine(Gadget):
                     'line_dash': self.dash}
         self.line = Line(x='x', y='y', **self.kw_)
         self.line_source = ColumnDataSource(data=dict(x=[], y=[]))
+        self.renderer = None
 
     def _update(self, *args, **kwargs):
         self.start = kwargs.setdefault('start', self.stave.start)
@@ -76,53 +80,62 @@ class hLine(Gadget):
         self.value = kwargs.setdefault('value', self.value)
         self._show()
 
+    def _add_glyph(self):
+        """Add the renderer of the line to stave.fig, once."""
+        if self.renderer is None:
+            self.renderer = self.stave.fig.add_glyph(self.line_source,
+                                                     self.line,
+                                                     name=self.name)
+
     def _show(self):
-        remove_fig(self.name, self.stave.fig)
-        self.line_source.data['x'] = [self.start, self.end]
-        self.line_source.data['y'] = [self.value, self.value]
-        self.stave.fig.add_glyph(self.line_source, self.line)
+        self.line_source.data = {'x': [self.start, self.end],
+                                 'y': [self.value, self.value]}
+        self._add_glyph()
 
 
 class hSlider(hLine):
     def __init__(self, stave, name, slider, *args, **kwargs):
         super().__init__(stave, name, slider.value, *args, **kwargs)
         self.slider = slider
+        self.slider.on_change('value', self._on_slider)
 
-    def _show(self):
-        remove_fig(self.name, self.stave.fig)
-        self.x = [self.start, self.end]
-        self.y = [self.slider.value, self.slider.value]
-        self.line_source.data.update({'x': self.x, 'y': self.y})
-        self.stave.fig.add_glyph(self.line_source, self.line)
-
-        def update(attr, old, new):
-            self.x = [self.start, self.end]
-            self.y = [self.slider.value, self.slider.value]
-            self.line_source.data.update({'x': self.x, 'y': self.y})
+    def _on_slider(self, attr, old, new):
+        self._show()
 
-        self.slider.on_change('value', update)
-        self.stave.tools.children.append(self.slider)
+    def _show(self):
+        self.value = self.slider.value
+        super()._show()
+        self._add_tool(self.slider)
 
 
-class pFunction(hLine):
+class pFunction(hSlider):
+    """Line through the runs of points of the stave above the value of the
+    slider, whose statistics are shown in the title of the slider."""
     def __init__(self, stave, name, slider, *args, **kwargs):
-        super().__init__(stave, name, slider.value, *args, **kwargs)
-        self.slider = slider
-        self.df = stave.df
-        self.source = ColumnDataSource(data=dict(x=self.df.index, y=self.df))
+        super().__init__(stave, name, slider, *args, **kwargs)
+        self.title = slider.title
+        self.exceedances, self._held = None, None
+        self._debounced_show = Debounce(self._show)
+
+    def _on_slider(self, attr, old, new):
+        self._debounced_show()
 
     def _show(self):
-        remove_fig(self.name, self.stave.fig)
-        self.y = self.df[self.df > self.slider.value]
-        self.x = self.y.index
-        self.line_source.data.update({'x': self.x, 'y': self.y})
-        self.stave.fig.add_glyph(self.line_source, self.line)
-
-        def update(attr, old, new):
-            self.data = self.stave.data.data[self.stave.feature]
-            self.y = self.data[self.data > self.slider.value]
-            self.x = self.y.index
-            self.line_source.data.update({'x': self.x, 'y': self.y})
-
-        self.slider.on_change('value', update)
-        self.stave.tools.children.append(self.slider)
+        held = self.stave.held
+        if held is None:
+            return
+        if held is not self._held:
+            self.exceedances = Exceedances(held[self.stave.feature])
+            self._held = held
+        ex, value = self.exceedances, self.slider.value
+        pos = ex.above(value)
+        # NaNs between the runs break the line
+        breaks = np.flatnonzero(np.diff(pos) != 1) + 1
+        self.line_source.data = {
+            'x': np.insert(ex.x[pos] / 1e6, breaks, np.nan),
+            'y': np.insert(ex.y[pos], breaks, np.nan)}
+        stats = ex.stats(value)
+        self.slider.title = "{}: {} runs, {} above (longest {})".format(
+            self.title, stats['runs'], stats['duration'], stats['longest'])
+        self._add_glyph()
+        self._add_tool(self.slider)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar representation of the intervals drawn by the cycle staves, and of
+the runs of a series above a threshold.
+"""
+# ===================================================================
+# Imports
+# ===================================================================
+
+import numpy as np
+import pandas as pd
+
+from tzigane.sampling import _ns
+
+# ===================================================================
+# Helper function
+# ===================================================================
+
+
+def _groups(starts):
+    """Helper function that returns the group ids and the first position of
+    each group, from a boolean array flagging the start of the groups."""
+    starts[0] = True
+    return np.cumsum(starts) - 1, np.flatnonzero(starts)
+
+
+# ===================================================================
+# Class definitions
+# ===================================================================
+
+
+class Intervals:
+    """Intervals as NumPy arrays: lower/upper bounds (int64 ns), shade codes
+    indexing the shades/colors tables. They are kept sorted by lower bound.
+    """
+    def __init__(self, lower, upper, codes, shades, colors):
+        order = np.argsort(lower, kind='mergesort')
+        self.lower = np.asarray(lower, dtype='int64')[order]
+        self.upper = np.asarray(upper, dtype='int64')[order]
+        self.codes = np.asarray(codes, dtype='int64')[order]
+        self.shades, self.colors = list(shades), np.asarray(colors)
+
+    def __len__(self):
+        return len(self.lower)
+
+    @classmethod
+    def from_digest(cls, dg):
+        """Intervals of the highlights of an anaximander HighlightDigest."""
+        shades = list(dg.shades())
+        colors = [dg.highlighter_type(shade).plargs.get('color', 'blank')
+                  for shade in shades]
+        lower, upper, codes = [], [], []
+        for code, shade in enumerate(shades):
+            highlights = list(dg.highlights(shade))
+            lower.append(_ns(pd.DatetimeIndex([h.lower for h in highlights])))
+            upper.append(_ns(pd.DatetimeIndex([h.upper for h in highlights])))
+            codes.append(np.full(len(highlights), code, dtype='int64'))
+        if not shades:
+            lower = upper = codes = [np.empty(0, dtype='int64')]
+        return cls(np.concatenate(lower), np.concatenate(upper),
+                   np.concatenate(codes), shades, colors)
+
+    def _reduce(self, starts, codes=None):
+        """Merge the groups of consecutive intervals flagged by starts."""
+        if not len(self):
+            return self
+        groups, first = _groups(starts)
+        lower = self.lower[first]
+        upper = np.maximum.reduceat(self.upper, first)
+        codes = self.codes[first] if codes is None else codes
+        return Intervals(lower, upper, codes, self.shades, self.colors)
+
+    def merged(self):
+        """Merge the adjacent (or overlapping) intervals of the same shade."""
+        if not len(self):
+            return self
+        reach = np.maximum.accumulate(self.upper)
+        starts = np.r_[True, (self.codes[1:] != self.codes[:-1]) |
+                       (self.lower[1:] > reach[:-1])]
+        return self._reduce(starts)
+
+    def coalesced(self, pixel):
+        """Merge the runs of consecutive intervals shorter than `pixel` ns
+        that fall within the same pixel, with the shade of the longest one.
+        """
+        if not len(self) or pixel <= 0:
+            return self
+        small = (self.upper - self.lower) < pixel
+        bucket = self.lower // int(pixel)
+        starts = np.r_[True, ~small[1:] | ~small[:-1] |
+                       (bucket[1:] != bucket[:-1])]
+        groups, first = _groups(starts)
+        # Within each group, the last position once sorted by duration
+        order = np.lexsort((self.upper - self.lower, groups))
+        last = np.r_[np.flatnonzero(np.diff(groups[order])), len(order) - 1]
+        return self._reduce(starts, self.codes[order[last]]).merged()
+
+    def to_source(self):
+        """Data of a quad ColumnDataSource (bounds in ms, as bokeh's)."""
+        n = len(self)
+        return {'left': self.lower / 1e6,
+                'right': self.upper / 1e6,
+                'shade': np.asarray(self.shades, dtype=object)[self.codes]
+                if n else np.empty(0, dtype=object),
+                'color': self.colors[self.codes] if n else
+                np.empty(0, dtype=object),
+                'bottom': np.zeros(n),
+                'top': np.ones(n)}
+
+
+class Exceedances:
+    """Points of a series above a threshold. The values are sorted once, so
+    that each threshold is answered with a binary search (O(log n + k))."""
+    def __init__(self, series):
+        self.x = _ns(series.index)
+        self.y = np.asarray(series.values, dtype='float64')
+        valid = np.flatnonzero(~np.isnan(self.y))
+        self.order = valid[np.argsort(self.y[valid], kind='mergesort')]
+        self.sorted = self.y[self.order]
+
+    def above(self, threshold):
+        """Positions of the points above threshold, in time order."""
+        i = np.searchsorted(self.sorted, threshold, side='right')
+        return np.sort(self.order[i:])
+
+    def runs(self, threshold):
+        """First and last positions of the runs of consecutive points above
+        threshold."""
+        pos = self.above(threshold)
+        if not len(pos):
+            return pos, pos
+        breaks = np.flatnonzero(np.diff(pos) != 1)
+        return pos[np.r_[0, breaks + 1]], pos[np.r_[breaks, len(pos) - 1]]
+
+    def stats(self, threshold):
+        """Number of runs and of points above threshold, total and longest
+        duration of the runs."""
+        first, last = self.runs(threshold)
+        duration = self.x[last] - self.x[first]
+        return {'runs': len(first),
+                'points': int((last - first + 1).sum()),
+                'duration': pd.Timedelta(int(duration.sum())),
+                'longest': pd.Timedelta(int(duration.max()) if len(first)
+                                        else 0)}
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The inventory of the devices (mac, device name, account, function), shared
+by all the scores of the process.
+"""
+# ===================================================================
+# Imports
+# ===================================================================
+
+import os
+import json
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Event, Lock, Thread, get_ident
+
+from tzigane import LOGGER
+import tzigane.util as util
+
+# Local snapshot of the inventory, served right away on restart.
+SNAPSHOT = os.environ.get('TZIGANE_INVENTORY',
+                          os.path.join(os.path.expanduser('~'), '.tzigane',
+                                       'inventory.json'))
+# Time (in seconds) between two refreshes of the inventory.
+REFRESH = float(os.environ.get('TZIGANE_INVENTORY_REFRESH', 3600))
+
+FIELDS = ['mac', 'device', 'account', 'function']
+# Maximum number of devices returned by a search (and sent to a Select).
+MAX_RESULTS = 50
+
+# ===================================================================
+# Helper function
+# ===================================================================
+
+
+def query_devices():
+    """Helper function that queries the inventory from the backend (see
+    tzigane.util.SOURCE)."""
+    return util.SOURCE.devices()
+
+
+def trigrams(text):
+    """Helper function that returns the set of trigrams of a string."""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+# ===================================================================
+# Class definitions
+# ===================================================================
+
+
+class Index:
+    """Lookups of the records by mac, device name and account, along with
+    the sorted names/macs (for prefix searches) and a trigram index (for
+    substring searches). It is rebuilt, never modified, so that it can be
+    read without lock."""
+    def __init__(self, records):
+        self.by_mac = records
+        self.by_device = defaultdict(list)
+        self.by_account = defaultdict(list)
+        self.trigrams = defaultdict(set)
+        self.text = {}
+        keys = []
+        for mac, r in records.items():
+            self.by_device[r['device']].append(mac)
+            self.by_account[r['account']].append(mac)
+            self.text[mac] = ' '.join([r['device'], mac, r['account']]).lower()
+            for gram in trigrams(self.text[mac]):
+                self.trigrams[gram].add(mac)
+            keys.extend([(r['device'].lower(), mac), (mac.lower(), mac)])
+        self.keys = sorted(keys)
+        for macs in self.by_account.values():
+            macs.sort(key=lambda mac: records[mac]['device'])
+
+    def prefixed(self, text):
+        """Macs whose device name or mac starts with text."""
+        res = []
+        for key, mac in self.keys[bisect_left(self.keys, (text,)):]:
+            if not key.startswith(text):
+                break
+            res.append(mac)
+        return res
+
+    def containing(self, text):
+        """Macs whose device name, mac or account contains text."""
+        grams = trigrams(text)
+        if not grams:
+            return [mac for mac, t in self.text.items() if text in t]
+        macs = set.intersection(*[self.trigrams.get(g, set()) for g in grams])
+        return [mac for mac in macs if text in self.text[mac]]
+
+
+class Inventory:
+    """Devices known to the process. `ready` is set as soon as there is
+    something to serve, either from the snapshot or from the backend."""
+    def __init__(self, path=SNAPSHOT):
+        self.path = path
+        self.records = {}
+        self.index = Index({})
+        self.ready = Event()
+        self._lock = Lock()
+
+    def devices(self, function=None):
+        """Records of the devices, possibly restricted to a function."""
+        return [r for r in self.records.values()
+                if function is None or r['function'] == function]
+
+    def get(self, mac):
+        return self.index.by_mac.get(mac)
+
+    def accounts(self, function=None):
+        """Sorted names of the accounts having devices of the function."""
+        index = self.index
+        return sorted(acc for acc, macs in index.by_account.items()
+                      if any(function in (None, index.by_mac[mac]['function'])
+                             for mac in macs))
+
+    def account_devices(self, account, function=None, limit=MAX_RESULTS):
+        """Records of the devices of an account, sorted by name."""
+        index = self.index
+        res = [index.by_mac[mac] for mac in index.by_account.get(account, [])]
+        res = [r for r in res if function in (None, r['function'])]
+        return res[:limit]
+
+    def find_device(self, name, account=None, function=None):
+        """Record of a device from its name (in the account, if given)."""
+        index = self.index
+        res = [index.by_mac[mac] for mac in index.by_device.get(name, [])]
+        res = [r for r in res if function in (None, r['function'])]
+        res.sort(key=lambda r: r['account'] != account)
+        return res[0] if res else None
+
+    def search(self, text, function=None, limit=MAX_RESULTS):
+        """Records of the devices whose name or mac starts with text first,
+        then of those whose name, mac or account contains it."""
+        text = text.strip().lower()
+        if not text:
+            return []
+        index = self.index
+        res, seen = [], set()
+        for mac in index.prefixed(text) + sorted(
+                index.containing(text),
+                key=lambda mac: index.by_mac[mac]['device']):
+            r = index.by_mac[mac]
+            if mac in seen or function not in (None, r['function']):
+                continue
+            seen.add(mac)
+            res.append(r)
+            if len(res) >= limit:
+                break
+        return res
+
+    def wait(self, timeout=None):
+        return self.ready.wait(timeout)
+
+    def load_snapshot(self):
+        try:
+            with open(self.path) as f:
+                records = json.load(f)
+        except (OSError, ValueError):
+            return False
+        self.update(records, save=False)
+        LOGGER.info("{} devices loaded from {}".format(len(records),
+                                                       self.path))
+        return True
+
+    def save_snapshot(self):
+        # Each process (e.g. gunicorn worker) writes its own temporary file
+        tmp = self.path + '.{}.{}.tmp'.format(os.getpid(),
+                                              get_ident())
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(list(self.records.values()), f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            LOGGER.warning("Cannot save the inventory: {}".format(e))
+
+    def update(self, records, save=True):
+        """Apply the differences with the known records (and rebuild the
+        index)."""
+        records = {r['mac']: {k: r[k] for k in FIELDS} for r in records}
+        with self._lock:
+            added = records.keys() - self.records.keys()
+            removed = self.records.keys() - records.keys()
+            changed = [mac for mac in records.keys() & self.records.keys()
+                       if records[mac] != self.records[mac]]
+            self.records = records
+            self.index = Index(records)
+        if added or removed or changed:
+            msg = "Inventory: {} added, {} removed, {} changed."
+            LOGGER.info(msg.format(len(added), len(removed), len(changed)))
+            if save:
+                self.save_snapshot()
+        self.ready.set()
+
+    def refresh(self):
+        LOGGER.info("Loading accounts...")
+        start = time.time()
+        try:
+            self.update(query_devices())
+        except Exception as e:
+            LOGGER.exception("Cannot load the accounts: {}".format(e))
+            return
+        LOGGER.info("Accounts loaded in {:.2f}s".format(time.time() - start))
+
+
+INVENTORY = Inventory()
+
+
+def load_accounts(refresh=REFRESH):
+    """Serve the snapshot (if any) right away, then query the backend in the
+    background every `refresh` seconds."""
+    INVENTORY.load_snapshot()
+
+    def _load():
+        while True:
+            INVENTORY.refresh()
+            time.sleep(refresh)
+
+    Thread(target=_load, daemon=True).start()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Timings of the queries, staves, gadgets and scores, along with the rows and
+(estimated) serialized bytes they produce, exposed in the Prometheus text
+format. The metrics are those of the process.
+"""
+# ===================================================================
+# Imports
+# ===================================================================
+
+import os
+import time
+from functools import wraps
+from threading import Lock
+
+import numpy as np
+
+from tzigane import LOGGER
+
+# Queries slower than this (in seconds) are logged.
+SLOW_QUERY = float(os.environ.get('TZIGANE_SLOW_QUERY', 2))
+PREFIX = 'tzigane_'
+
+# ===================================================================
+# Helper function
+# ===================================================================
+
+
+def payload(data):
+    """Helper function that returns the rows and estimated bytes of the data
+    of a ColumnDataSource once serialized (numeric arrays are sent as
+    base64, datetimes as float milliseconds, the rest as JSON). It runs on
+    every render: the JSON is estimated from the lengths of the strings
+    (quoted, and separated by commas), other values counting for 8 bytes.
+    """
+    rows, nbytes = 0, 0
+    for values in data.values():
+        values = np.asarray(values)
+        rows = max(rows, len(values))
+        if values.dtype.kind in 'biufmM':
+            nbytes += (8 * len(values) if values.dtype.kind in 'mM'
+                       else values.nbytes) * 4 // 3
+        elif values.dtype.kind in 'SU':
+            nbytes += int(np.char.str_len(values).sum()) + 3 * len(values)
+        else:
+            nbytes += sum(len(v) + 3 if isinstance(v, str) else 8
+                          for v in values.ravel())
+    return rows, nbytes
+
+
+def _labels(labels):
+    text = ','.join('{}="{}"'.format(k, str(v).replace('"', "'"))
+                    for k, v in sorted(labels.items()))
+    return '{' + text + '}' if text else ''
+
+
+# ===================================================================
+# Class definitions
+# ===================================================================
+
+
+class Registry:
+    """Count, total, last and max time of every (name, labels), along with
+    the rows and bytes they produced."""
+    def __init__(self):
+        self._metrics = {}
+        self._lock = Lock()
+
+    def observe(self, name, seconds, rows=None, nbytes=None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            m = self._metrics.setdefault(key, {'count': 0, 'seconds': 0.,
+                                               'max': 0., 'last': 0.,
+                                               'rows': 0, 'bytes': 0})
+            m['count'] += 1
+            m['seconds'] += seconds
+            m['last'] = seconds
+            m['max'] = max(m['max'], seconds)
+            m['rows'] += rows or 0
+            m['bytes'] += nbytes or 0
+
+    def snapshot(self):
+        """[(name, labels, values)], sorted by name."""
+        with self._lock:
+            return sorted((name, dict(labels), dict(values))
+                          for (name, labels), values in
+                          self._metrics.items())
+
+    def clear(self):
+        with self._lock:
+            self._metrics.clear()
+
+    def prometheus(self, gauges={}):
+        """The metrics (and the gauges, {name: value}) in the Prometheus
+        text format."""
+        lines, typed = [], set()
+        for name, labels, m in self.snapshot():
+            name, lab = PREFIX + name, _labels(labels)
+            if name not in typed:
+                typed.add(name)
+                lines += ['# TYPE {}_seconds summary'.format(name),
+                          '# TYPE {}_seconds_max gauge'.format(name),
+                          '# TYPE {}_rows_total counter'.format(name),
+                          '# TYPE {}_bytes_total counter'.format(name)]
+            for suffix, value in [('_seconds_count', m['count']),
+                                  ('_seconds_sum', m['seconds']),
+                                  ('_seconds_max', m['max']),
+                                  ('_rows_total', m['rows']),
+                                  ('_bytes_total', m['bytes'])]:
+                lines.append('{}{}{} {}'.format(name, suffix, lab, value))
+        for name, value in sorted(gauges.items()):
+            lines += ['# TYPE {}{} gauge'.format(PREFIX, name),
+                      '{}{} {}'.format(PREFIX, name, value)]
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Timer:
+    """Context manager observing its duration in registries (REGISTRY by
+    default). rows and nbytes can be set within the block."""
+    def __init__(self, name, registries=None, **labels):
+        self.name, self.labels = name, labels
+        self.registries = [REGISTRY] if registries is None else registries
+        self.rows = self.nbytes = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.started
+        for registry in self.registries:
+            registry.observe(self.name, self.seconds, self.rows, self.nbytes,
+                             **self.labels)
+
+
+def timed_call(func, name, registries=None, **labels):
+    """Helper function that returns func, timed (e.g. to run it on the
+    worker pool)."""
+    @wraps(func)
+    def call(*args, **kwargs):
+        with Timer(name, registries, **labels):
+            return func(*args, **kwargs)
+    return call
+
+
+def instrumented(name, source=True):
+    """Decorator timing a method of a stave or score, labelled with its
+    class and title, along with the payload of its source (if any, and
+    unless source is False)."""
+    def decorate(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with Timer(name, kind=type(self).__name__,
+                       title=self.title) as timer:
+                res = method(self, *args, **kwargs)
+                if source and getattr(self, 'source', None) is not None:
+                    timer.rows, timer.nbytes = payload(self.source.data)
+            return res
+        return wrapper
+    return decorate
+
+
+def html(snapshot, gauges={}):
+    """Helper function that returns an HTML table of metrics (cf.
+    Registry.snapshot) and of gauges."""
+    head = ['metric', 'labels', 'count', 'last (s)', 'mean (s)', 'max (s)',
+            'rows', 'bytes']
+    cells = [[name, _labels(labels), m['count'], '{:.3f}'.format(m['last']),
+              '{:.3f}'.format(m['seconds'] / m['count']),
+              '{:.3f}'.format(m['max']), m['rows'], m['bytes']]
+             for name, labels, m in snapshot]
+    cells += [[name, '', '', '', '', '', '', value]
+              for name, value in sorted(gauges.items())]
+    rows = ['<tr>{}</tr>'.format(''.join('<th>{}</th>'.format(h)
+                                         for h in head))]
+    rows += ['<tr>{}</tr>'.format(''.join('<td>{}</td>'.format(c)
+                                          for c in row)) for row in cells]
+    return '<table style="font-size:11px">{}</table>'.format(''.join(rows))
+
+
+def slow_query(seconds, msg):
+    """Log a query slower than SLOW_QUERY."""
+    if seconds > SLOW_QUERY:
+        LOGGER.warning("Slow query ({:.2f}s): {}".format(seconds, msg))
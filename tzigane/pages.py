@@ -42,3 +42,24 @@ class MetricSummaryBatchScore(tsc.MetricSummaryScore, tsc.BatchScore):
     """ To have an overview of the metrics."""
     def __init__(self, title, *args, **kwargs):
         super().__init__(title, *args, **kwargs)
+
+
+class ComparisonBatchScore(tsc.ComparisonScore, tsc.BatchScore):
+    """ To compare a feature between devices or periods."""
+    def __init__(self, title, *args, **kwargs):
+        super().__init__(title, *args, **kwargs)
+
+
+class FleetScanBatchScore(tsc.FleetScanScore, tsc.BatchScore):
+    """ To rank the devices against their thresholds."""
+    def __init__(self, title, *args, **kwargs):
+        super().__init__(title, *args, **kwargs)
+
+
+APPS = {'batch': PressProdBatchScore,
+        'streaming': PressProdStreamingScore,
+        'condition': ConditionBatchScore,
+        'feature_summary': FeatureSummaryBatchScore,
+        'metric_summary': MetricSummaryBatchScore,
+        'comparison': ComparisonBatchScore,
+        'fleet': FleetScanBatchScore}
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Opt-in profiling of the callbacks of the scores: when profiling is on (for
+every session with TZIGANE_PROFILE=1, or for one with ?profile=1), the
+callbacks are wrapped with cProfile when they are bound, and every call is
+dumped to PROFILE_DIR. Otherwise the callbacks are bound as they are.
+"""
+# ===================================================================
+# Imports
+# ===================================================================
+
+import os
+import io
+import re
+import json
+import time
+import pstats
+import cProfile
+import threading
+from functools import wraps
+
+from tzigane import LOGGER
+
+PROFILE = os.environ.get('TZIGANE_PROFILE', '') not in ('', '0', 'false')
+PROFILE_DIR = os.environ.get('TZIGANE_PROFILE_DIR',
+                             os.path.join(os.path.expanduser('~'),
+                                          '.tzigane', 'profiles'))
+# One line per dumped profile, newest last.
+INDEX = 'index.jsonl'
+# Number of profiles kept, the oldest ones being removed every PRUNE_EVERY
+# dumps (of the process).
+PROFILE_KEEP = int(os.environ.get('TZIGANE_PROFILE_KEEP', 500))
+PRUNE_EVERY = 50
+# Orders of the reports.
+SORTS = ['cumulative', 'tottime', 'calls']
+
+_LOCK = threading.Lock()
+# The callbacks called by a profiled one (in the same thread) are part of
+# its profile.
+_ACTIVE = threading.local()
+_DUMPS = 0
+
+# ===================================================================
+# Helper function
+# ===================================================================
+
+
+def profiled(func, name, enabled=None, path=None):
+    """Helper function that returns func, wrapped so that each call is
+    profiled and dumped, if enabled (PROFILE by default), or func itself."""
+    if not (PROFILE if enabled is None else enabled):
+        return func
+    path = PROFILE_DIR if path is None else path
+
+    @wraps(func)
+    def call(*args, **kwargs):
+        if getattr(_ACTIVE, 'on', False):
+            return func(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler runs (a single one can since Python 3.12)
+            return func(*args, **kwargs)
+        _ACTIVE.on = True
+        started = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            _ACTIVE.on = False
+            dump(profile, name, started, time.time() - started, path)
+    return call
+
+
+def dump(profile, name, started, seconds, path=PROFILE_DIR):
+    """Helper function that writes a profile and adds it to the index."""
+    name = re.sub(r'[^\w.-]', '_', name)
+    stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(started))
+    file = '{}.{:03d}-{}-{}.prof'.format(stamp, int(started * 1000) % 1000,
+                                         name, os.getpid())
+    global _DUMPS
+    entry = {'file': file, 'name': name, 'time': started, 'seconds': seconds,
+             'pid': os.getpid()}
+    try:
+        os.makedirs(path, exist_ok=True)
+        profile.dump_stats(os.path.join(path, file))
+        with _LOCK:
+            with open(os.path.join(path, INDEX), 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+            _DUMPS += 1
+            if _DUMPS % PRUNE_EVERY == 0:
+                prune(path)
+    except OSError as e:
+        LOGGER.warning("Cannot dump the profile of {}: {}".format(name, e))
+
+
+def prune(path=PROFILE_DIR, keep=PROFILE_KEEP):
+    """Helper function that removes the profiles beyond the `keep` newest
+    ones, along with their lines of the index."""
+    with open(os.path.join(path, INDEX)) as f:
+        lines = f.readlines()
+    if len(lines) <= keep:
+        return
+    for line in lines[:len(lines) - keep]:
+        try:
+            os.remove(os.path.join(path, json.loads(line)['file']))
+        except (OSError, ValueError, KeyError):
+            continue
+    tmp = os.path.join(path, '{}.{}.{}.tmp'.format(INDEX, os.getpid(),
+                                                   threading.get_ident()))
+    with open(tmp, 'w') as f:
+        f.writelines(lines[len(lines) - keep:])
+    os.replace(tmp, os.path.join(path, INDEX))
+
+
+def index(path=PROFILE_DIR, limit=200):
+    """Helper function that returns the entries of the latest profiles,
+    newest first."""
+    try:
+        with open(os.path.join(path, INDEX)) as f:
+            lines = f.readlines()
+    except OSError:
+        return []
+    entries = []
+    for line in lines[::-1][:limit]:
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            continue
+    return entries
+
+
+def report(file, path=PROFILE_DIR, sort='cumulative', limit=60):
+    """Helper function that returns the statistics of a profile as text
+    (None if there is no such profile)."""
+    if os.path.basename(file) != file or not file.endswith('.prof') or \
+            not os.path.exists(os.path.join(path, file)):
+        return None
+    out = io.StringIO()
+    stats = pstats.Stats(os.path.join(path, file), stream=out)
+    stats.sort_stats(sort).print_stats(limit)
+    return out.getvalue()
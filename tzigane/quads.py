@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Computation of the quads drawn by the stacked and heatmap staves, as flat
+NumPy arrays ready for a ColumnDataSource.
+"""
+# ===================================================================
+# Imports
+# ===================================================================
+
+import numpy as np
+import pandas as pd
+
+from tzigane.sampling import _ns
+
+# ===================================================================
+# Helper function
+# ===================================================================
+
+
+def edges(index):
+    """Helper function that returns the left and right bounds (in ms, as
+    bokeh's) of the rows of a time index, the last row being as wide as the
+    one before it."""
+    left = _ns(index)
+    right = np.empty_like(left)
+    right[:-1] = left[1:]
+    if len(left):
+        right[-1] = 2 * left[-1] - left[-2] if len(left) > 1 else left[-1]
+    return left / 1e6, right / 1e6
+
+
+def stack(values, left, right, colors, legends):
+    """Helper function that stacks the rows of a (rows x states) array as
+    percentages of their totals. Rows with a zero total get empty quads.
+    The quads are returned state by state, with a legend per state."""
+    values = np.nan_to_num(np.asarray(values, dtype='float64'))
+    n, k = values.shape
+    total = values.sum(axis=1, keepdims=True)
+    percent = np.divide(100 * values, total, out=np.zeros_like(values),
+                        where=total > 0)
+    top = np.cumsum(percent, axis=1)
+    return {'left': np.tile(left, k),
+            'right': np.tile(right, k),
+            'bottom': (top - percent).T.ravel(),
+            'top': top.T.ravel(),
+            'percent': percent.T.ravel(),
+            'color': np.repeat(np.asarray(colors, dtype=object), n),
+            'legend': np.repeat(np.asarray(legends, dtype=object), n)}
+
+
+def rebin(index, start, end, width):
+    """Helper function that counts the records of a log (from the timestamps
+    of its index) in bins of the given width over [start, end). The bins
+    are aligned on multiples of the width (since the epoch)."""
+    start, end = _ns(pd.DatetimeIndex([start, end]))
+    width = pd.Timedelta(width).value
+    start -= start % width
+    n = max(1, -(-(end - start) // width))
+    ts = _ns(index)
+    ts = ts[(ts >= start) & (ts < end)]
+    counts = np.bincount((ts - start) // width, minlength=n)
+    left = start + width * np.arange(n, dtype='int64')
+    return left / 1e6, (left + width) / 1e6, counts
+
+
+def heat(counts, left, right, palette):
+    """Helper function that returns the quads of a one-row heatmap: the
+    colors split [0, max] evenly over the palette, and the counts are
+    written on the non-empty cells."""
+    counts = np.nan_to_num(np.asarray(counts, dtype='float64'))
+    counts = np.clip(counts, 0, None).astype('int64')
+    n = len(counts)
+    codes = counts * len(palette) // (counts.max() + 1) if n else counts
+    return {'left': left,
+            'right': right,
+            'bottom': np.zeros(n),
+            'top': np.ones(n),
+            'x': (left + right) / 2,
+            'y': np.full(n, 0.5),
+            'count': counts,
+            'color': np.asarray(palette, dtype=object)[codes],
+            'text': np.where(counts > 0, counts.astype(str), '')}
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Downsampling of the time series to the resolution of the figures.
+"""
+# ===================================================================
+# Imports
+# ===================================================================
+
+import numpy as np
+import pandas as pd
+
+# Number of points kept per horizontal pixel.
+POINTS_PER_PIXEL = 2
+
+# ===================================================================
+# Helper function
+# ===================================================================
+
+
+def _ns(index):
+    """Helper function that returns a DatetimeIndex as int64 nanoseconds."""
+    return np.asarray(index.values).astype('datetime64[ns]').view('int64')
+
+
+def _buckets(x, n_buckets):
+    """Helper function that assigns sorted timestamps to n equal buckets."""
+    span = max(int(x[-1] - x[0]), 1)
+    bucket = ((x - x[0]) * (n_buckets / span)).astype('int64')
+    return np.minimum(bucket, n_buckets - 1)
+
+
+def minmax(x, y, n_buckets):
+    """Positions of the min and max of y in each of n equal time buckets
+    (plus the first and last points), in increasing order."""
+    keep = np.flatnonzero(~np.isnan(y))
+    if len(keep) <= 2 * n_buckets:
+        return keep
+    x, y = x[keep], y[keep]
+    bucket = _buckets(x, n_buckets)
+    # Within each bucket, the first position is the min and the last the max
+    order = np.lexsort((y, bucket))
+    first = np.flatnonzero(np.r_[True, bucket[order][1:] !=
+                                 bucket[order][:-1]])
+    last = np.r_[first[1:] - 1, len(order) - 1]
+    idx = np.unique(np.r_[0, order[first], order[last], len(x) - 1])
+    return keep[idx]
+
+
+def lttb(x, y, n_out):
+    """Positions of the points kept by the Largest-Triangle-Three-Buckets
+    algorithm. The areas are computed with NumPy within each bucket."""
+    keep = np.flatnonzero(~np.isnan(y))
+    if len(keep) <= n_out or n_out < 3:
+        return keep
+    x, y = x[keep].astype('float64'), y[keep]
+    # Bucket boundaries, the first and last points have their own bucket
+    edges = np.linspace(1, len(x) - 1, n_out - 1).astype('int64')
+    sums_x = np.add.reduceat(x[1:-1], edges[:-1] - 1)
+    sums_y = np.add.reduceat(y[1:-1], edges[:-1] - 1)
+    counts = np.diff(edges)
+    avg_x = np.r_[sums_x / counts, x[-1]]
+    avg_y = np.r_[sums_y / counts, y[-1]]
+
+    res = np.empty(n_out, dtype='int64')
+    res[0], res[-1] = 0, len(x) - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        area = np.abs((x[a] - avg_x[i + 1]) * (y[lo:hi] - y[a]) -
+                      (x[a] - x[lo:hi]) * (avg_y[i + 1] - y[a]))
+        a = lo + int(area.argmax())
+        res[i + 1] = a
+    return keep[res]
+
+
+def downsample(df, width, mode='minmax', ppp=POINTS_PER_PIXEL):
+    """Reduce a timestamp-indexed frame to about ppp points per pixel of a
+    figure `width` pixels wide. Each column is reduced independently and the
+    union of the kept rows is returned."""
+    if len(df) <= ppp * width:
+        return df
+    x = _ns(df.index)
+    keep = []
+    for col in df:
+        y = pd.to_numeric(df[col], errors='coerce').values.astype('float64')
+        if mode == 'lttb':
+            keep.append(lttb(x, y, ppp * width))
+        else:
+            keep.append(minmax(x, y, ppp * width // 2))
+    return df.iloc[np.unique(np.concatenate(keep))]
+
+
+def resample(x, y, start, end, n):
+    """Mean of y over n equal time bins of [start, end) (timestamps in ns),
+    NaN for the bins without any value."""
+    keep = (x >= start) & (x < end) & ~np.isnan(y)
+    bins = ((x[keep] - start) * (n / (end - start))).astype('int64')
+    bins = np.minimum(bins, n - 1)
+    counts = np.bincount(bins, minlength=n)
+    sums = np.bincount(bins, weights=y[keep], minlength=n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
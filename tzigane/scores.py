@@ -7,28 +7,40 @@ The basic classes are defined in this file.
 # Imports
 # ===================================================================
 
+import os
 import abc
 import time
+import random
+import numpy as np
 import pandas as pd
 from bokeh.io import curdoc
-from threading import Thread
 from tzigane.util import _qrange
 from functools import partial
 from dataforge import PROJECT_ID
 import dataforge.environment as env
 from bokeh.models.widgets import TextInput, Select, Button, Div
+from bokeh.models.widgets import DataTable, NumberFormatter, TableColumn
 from bokeh.models import ColumnDataSource
 from bokeh.layouts import layout, row, widgetbox
 
+import tzigane.assessment as ass
+import tzigane.fleet as fl
+import tzigane.metrics as mtr
+import tzigane.profiling as prf
 import tzigane.staves as stv
-from tzigane.util import sequence
+import tzigane.streaming as strm
+from tzigane.util import CACHE, FEATURE_PERIODS, METRIC_PERIODS, WORKERS
+from tzigane.util import resolution_for, sequence
 from tzigane.gadgets import Base
+from tzigane.inventory import INVENTORY
 from tzigane import LOGGER
 
 ACCEL = 'accel_energy_512'
 
-ACCOUNTS = None
-ACCOUNTS_LOADED = False
+# Time (in seconds) after which a stave that is still loading is given up.
+STAVE_TIMEOUT = float(os.environ.get('TZIGANE_STAVE_TIMEOUT', 60))
+# Period (in ms) of the refresh of the debug panel (cf. Score.debug).
+DEBUG_REFRESH = 2000
 
 FEATURE_SUMMARIES = ['summary_10s', 'summary_1m', 'summary_5m', 'summary_30m',
                      'summary_6H', 'summary_1D', 'summary_7D']
@@ -36,6 +48,9 @@ FEATURE_SUMMARIES = ['summary_10s', 'summary_1m', 'summary_5m', 'summary_30m',
 METRIC_SUMMARIES = ['MetricSummary5m', 'MetricSummary30m', 'MetricSummaryS1',
                     'MetricSummaryS2', 'MetricSummaryS3', 'MetricSummary1D',
                     'MetricSummary1M']
+# Bin widths of the production heatmap, re-binned from the stroke logs
+# ('table' keeps the granularity of the metric summary).
+HEATMAP_BINS = ['table', '5min', '30min', '1h', '6h', '1D', '7D']
 
 # ===================================================================
 # Helper function
@@ -46,38 +61,18 @@ def remove_tool(name, tools):
     tools.children = list(filter(lambda x: x.name != name, tools.children))
 
 
-def load_accounts():
-    def _load():
-        global ACCOUNTS, ACCOUNTS_LOADED
-        LOGGER.info("Loading accounts...")
-        start = time.time()
-        ACCOUNTS = env.Account.requery_all()
-        ACCOUNTS_LOADED = True
-        LOGGER.info("Accounts loaded in {:.2f}s".format(time.time() - start))
-
-    Thread(target=_load).start()
-
-
-def get_feature_range_from(start, end):
-    duration = end - start
-    if duration < pd.Timedelta(2, 'h'):
-        return 'summary_10s'
-    elif duration < pd.Timedelta(6, 'h'):
-        return 'summary_1m'
-    elif duration < pd.Timedelta(1, 'd'):
-        return 'summary_5m'
-    elif duration < pd.Timedelta(7, 'd'):
-        return 'summary_30m'
+def get_feature_range_from(start, end, points=150):
+    """Coarsest feature summary with at least `points` rows over the range
+    (the finest one for short ranges)."""
+    return resolution_for(start, end, FEATURE_PERIODS, points) or \
+        FEATURE_SUMMARIES[0]
 
 
-def get_metric_range_from(start, end):
-    duration = end - start
-    if duration < pd.Timedelta(1, 'd'):
-        return 'MetricSummary5m'
-    elif duration < pd.Timedelta(7, 'h'):
-        return 'MetricSummary30m'
-    elif duration < pd.Timedelta(30, 'd'):
-        return 'MetricSummary1D'
+def get_metric_range_from(start, end, points=24):
+    """Coarsest metric summary with at least `points` rows over the range
+    (the finest one for short ranges)."""
+    return resolution_for(start, end, METRIC_PERIODS, points) or \
+        METRIC_SUMMARIES[0]
 
 
 # ===================================================================
@@ -86,7 +81,10 @@ def get_metric_range_from(start, end):
 
 
 class Score(Base):
-    """Class to gather all the elements in a document."""
+    """Class to gather all the elements in a document. With debug = True
+    (e.g. ?debug=1 in the url), a panel below the staves shows their timings
+    and the ones of the queries. With profile = True (e.g. ?profile=1), the
+    callbacks are profiled (cf. tzigane.profiling)."""
     def __init__(self, title, *args, **kwargs):
         super().__init__()
         self.doc = self.app.create_document()
@@ -117,60 +115,113 @@ class Score(Base):
         self._refresh = Button(label="Refresh")
         self._submit = Button(label="Submit")
         self._initialized = False
+        self._pending = {}
+        self.debug = kwargs.setdefault('debug', False)
+        self.profile = kwargs.setdefault('profile', prf.PROFILE)
+        self.metrics = mtr.Registry()
 
     def __call__(self):
         self._init_environment()
         self._init_toolbar()
         self.refresh_range()
 
-        self._refresh.on_click(self.refresh_range)
-        self._submit.on_click(partial(self.refresh_range, 'submit'))
+        refresh_range = self._profiled(self.refresh_range, 'refresh_range')
+        self._refresh.on_click(refresh_range)
+        self._submit.on_click(partial(refresh_range, 'submit'))
         self._initialized = True
+        if self.debug:
+            self._init_debug()
+
+    def close(self):
+        """Release what the score holds once its session is destroyed."""
+        for future in self._pending.values():
+            future.cancel()
+        self._pending = {}
+        for stave in self.staves.values():
+            stave.stop_streaming()
+        self.staves = {}
+        self.plots.children = []
+
+    def _profiled(self, func, name):
+        """The callback func, profiled if the score is (bound as it is
+        otherwise)."""
+        return prf.profiled(func, '{}.{}'.format(self.title, name),
+                            self.profile)
+
+    def _init_debug(self):
+        self._debug = Div(text='', width=1200)
+        self.layout.children.append(row(self._debug))
+        self._update_debug()
+        if self.doc.session_context is not None:
+            self.doc.add_periodic_callback(self._update_debug, DEBUG_REFRESH)
+
+    def _update_debug(self):
+        """Timings of the staves of the score, then of the queries of the
+        process, along with the statistics of the cache."""
+        queries = [m for m in mtr.REGISTRY.snapshot()
+                   if m[0] in ('sequence', 'backend_query')]
+        gauges = {'cache_' + k: v for k, v in CACHE.stats().items()}
+        self._debug.text = mtr.html(self.metrics.snapshot() + queries,
+                                    gauges)
 
     def _init_environment(self):
-        """This has to be modified to consider devices other than presses."""
-        global ACCOUNTS, ACCOUNTS_LOADED
+        """This has to be modified to consider devices other than presses.
+        Within the server, the score is only created once the inventory is
+        ready (cf. ScoreHandler), so that this does not wait."""
         start = time.time()
-        while not ACCOUNTS_LOADED:
+        while not INVENTORY.wait(5):
             msg = "Waiting for the accounts to be loaded... {:.2f}s."
             LOGGER.info(msg.format(time.time() - start))
-            time.sleep(5)
-        self.accounts = ACCOUNTS
-        if hasattr(self, 'function'):
-            self.macs = [d.mac for acc in self.accounts for d in acc.devices()
-                         if d.function == self.function]
-        else:
-            self.macs = [d.mac for acc in self.accounts for d in acc.devices()]
-        # Needed for condition. Accounts are empty
-        self.devices = [env.Device[mac] for mac in self.macs]
-        df = {'mac': self.macs,
-              'device': [str(d) for d in self.devices],
-              'account': [d.account.name for d in self.devices]}
-        self.df = pd.DataFrame(df, index=self.macs)
+        self._syncing = False
 
     def _init_toolbar(self):
+        function = getattr(self, 'function', None)
         self._project = TextInput(title="Project:", value=self.project)
         if hasattr(self, 'mac'):
             mac = self.mac
         else:
-            mac = self.df.mac.sample(1)[0]
-        dev = self.df[self.df.mac == mac].device.iloc[0]
-        acc = self.df[self.df.mac == mac].account.iloc[0]
+            mac = random.choice(INVENTORY.devices(function))['mac']
+        record = INVENTORY.get(mac)
+        dev, acc = record['device'], record['account']
         self._account = Select(title="Account:", value=acc,
-                               options=list(set(self.df.account)))
+                               options=INVENTORY.accounts(function))
         self._device = Select(title="Device:", value=dev,
-                              options=list(set(self.df[self.df.account ==
-                                                       acc].device)))
+                              options=self._device_options(acc, dev))
+        self._search = TextInput(title="Search device:")
         self._mac = TextInput(title="Mac:", value=mac)
-        self._account.on_change('value', self.update_account)
-        self._device.on_change('value', self.update_device)
-        self._mac.on_change('value', self.update_mac)
+        self._account.on_change('value', self._profiled(self.update_account,
+                                                        'update_account'))
+        self._device.on_change('value', self._profiled(self.update_device,
+                                                       'update_device'))
+        self._mac.on_change('value', self._profiled(self.update_mac,
+                                                    'update_mac'))
+        self._search.on_change('value', self.update_search)
         self.toolbar.children.append(row(self.logo,
                                          self._project,
                                          self._mac,
                                          self._account,
+                                         self._search,
                                          self._device))
 
+    def _device_options(self, account, device):
+        """The (limited) devices of an account, including the given one."""
+        function = getattr(self, 'function', None)
+        options = [r['device']
+                   for r in INVENTORY.account_devices(account, function)]
+        return options if device in options else [device] + options
+
+    def _select(self, record):
+        """Show a device in the toolbar, without cascading the callbacks."""
+        self._syncing = True
+        try:
+            self._account.value = record['account']
+            self._device.options = self._device_options(record['account'],
+                                                        record['device'])
+            self._device.value = record['device']
+            self._mac.value = record['mac']
+        finally:
+            self._syncing = False
+
     def refresh_range(self, *args, **kwargs):
         if 'submit' in args:
             self.start, self.end = _qrange(self._start.value, self._end.value)
@@ -185,36 +236,161 @@ class Score(Base):
 
     def update_account(self, attr, old, new, device=None):
         """Mandatory for toolbar."""
+        if self._syncing:
+            return
+        function = getattr(self, 'function', None)
         if device is not None:
-            self._device.value = device
+            record = INVENTORY.find_device(device, new, function)
         else:
-            self._device.options = list(self.df.loc[self.df.account == new,
-                                                    'device'])
-            self._device.value = self._device.options[0]
+            record = INVENTORY.account_devices(new, function)[0]
+        self._select(record)
+        self.update_staves({'mac': record['mac']})
 
     def update_mac(self, attr, old, new):
         """Mandatory for toolbar."""
-        if new in self.df.mac:
-            acc, dev = self.df.loc[new, ['account', 'device']]
-            self._account.value = acc
-            self.update_account('value', acc, acc, device=dev)
+        if self._syncing:
+            return
+        record = INVENTORY.get(new)
+        if record is not None and \
+                getattr(self, 'function', record['function']) == \
+                record['function']:
+            self._select(record)
+            self.update_staves({'mac': new})
         else:
             self._mac.value = old
 
     def update_device(self, attr, old, new):
         """Mandatory for toolbar."""
-        self._mac.value = self.df.loc[self.df.device == new, 'mac'].iloc[0]
-        self.update_staves({'mac': self._mac.value})
-
+        if self._syncing:
+            return
+        function = getattr(self, 'function', None)
+        record = INVENTORY.find_device(new, self._account.value, function)
+        self._select(record)
+        self.update_staves({'mac': record['mac']})
+
+    def update_search(self, attr, old, new):
+        """Restrict the devices to the (first) matches of the search."""
+        records = INVENTORY.search(new, getattr(self, 'function', None))
+        if records:
+            options = [r['device'] for r in records]
+            if self._device.value not in options:
+                options.insert(0, self._device.value)
+            self._device.options = options
+        elif not new.strip():
+            self._device.options = self._device_options(self._account.value,
+                                                        self._device.value)
+
+    @mtr.instrumented('score_update_staves', source=False)
     def update_staves(self, val={}):
         if 'mac' in val.keys():
+            for stave in self.staves.values():
+                stave.stop_streaming()
             self._plot()
         if 'time_range' in val.keys():
             for name, stave in self.staves.items():
                 stave.update_time_range(*val['time_range'])
-            for name, stave in self.staves.items():
-                stave._update_fig()
-                stave._update_gadgets()
+            self.load_staves(self.staves)
+
+    def _prepare(self, loads, build):
+        """Run the loads (name: function) concurrently on the worker pool,
+        then build the staves from their results (name: result) on the
+        document thread, once they are all there (synchronously out of a
+        session). This is where the data the staves are created from is
+        fetched (device specs, tables shared by the staves), so that nothing
+        blocks the document thread. A later call, or load_staves,
+        supersedes it."""
+        doc = self.doc
+        for future in self._pending.values():
+            future.cancel()
+        self._pending = pending = {('prepare', name): WORKERS.submit(load)
+                                   for name, load in loads.items()}
+        callback = self._profiled(partial(self._prepared, pending, build),
+                                  'prepare')
+        if doc.session_context is None:
+            return callback()
+        for future in pending.values():
+            future.add_done_callback(
+                lambda f: doc.add_next_tick_callback(callback))
+
+    def _prepared(self, pending, build):
+        if self._pending is not pending or \
+                not all(future.done() for future in pending.values()):
+            return
+        self._pending = {}
+        try:
+            loaded = {name: future.result(timeout=STAVE_TIMEOUT)
+                      for (_, name), future in pending.items()}
+            build(loaded)
+        except Exception as e:
+            LOGGER.exception("Cannot plot {}: {}".format(self.title, e))
+
+    def load_staves(self, staves):
+        """Fetch the data of the staves concurrently, then render each of
+        them on the document thread. Within a session, the rendering is
+        scheduled with add_next_tick_callback as soon as the data of a
+        stave is there, so that the refresh takes as long as the slowest
+        stave. The stages of a stave (cf. Stave._stages) are submitted
+        with the ones of the other staves (the first ones of all the staves
+        first) and rendered as they come, unless a later one was already
+        rendered. Out of a session, only the last stage is loaded. The
+        loads of a previous call are discarded (and cancelled, if they have
+        not started yet)."""
+        doc = self.doc
+        registries = [mtr.REGISTRY, self.metrics]
+        for future in self._pending.values():
+            future.cancel()
+        if doc.session_context is None:
+            self._pending = pending = {
+                (name, 0): WORKERS.submit(mtr.timed_call(
+                    stave._load, 'stave_load', registries, stave=name,
+                    stage=0))
+                for name, stave in staves.items()}
+            for (name, stage), future in pending.items():
+                self._render_stave(name, staves[name], stage, future)
+            return
+        stages = {name: stave._stages() for name, stave in staves.items()}
+        self._pending = pending = {}
+        for stage in range(max(map(len, stages.values()), default=0)):
+            for name, loads in stages.items():
+                if stage < len(loads):
+                    load = self._profiled(loads[stage], 'load_' + name)
+                    pending[(name, stage)] = WORKERS.submit(mtr.timed_call(
+                        load, 'stave_load', registries, stave=name,
+                        stage=stage))
+        for (name, stage), future in pending.items():
+            callback = self._profiled(
+                partial(self._render_stave, name, staves[name], stage,
+                        future), 'render_' + name)
+            future.add_done_callback(
+                lambda f, cb=callback: doc.add_next_tick_callback(cb))
+            doc.add_timeout_callback(partial(self._expire_stave, name, stage,
+                                             future),
+                                     int(1000 * STAVE_TIMEOUT))
+
+    def _render_stave(self, name, stave, stage, future):
+        if self._pending.get((name, stage)) is not future:
+            return
+        # The earlier stages are superseded
+        for key in [k for k in self._pending
+                    if k[0] == name and k[1] <= stage]:
+            self._pending.pop(key).cancel()
+        try:
+            loaded = future.result(timeout=STAVE_TIMEOUT)
+            with mtr.Timer('stave_render', [mtr.REGISTRY, self.metrics],
+                           stave=name, stage=stage) as timer:
+                stave._render(loaded)
+                if getattr(stave, 'source', None) is not None:
+                    timer.rows, timer.nbytes = mtr.payload(stave.source.data)
+            stave._update_gadgets()
+        except Exception as e:
+            LOGGER.exception("Cannot update {}: {}".format(name, e))
+
+    def _expire_stave(self, name, stage, future):
+        if self._pending.get((name, stage)) is future and not future.done():
+            del self._pending[(name, stage)]
+            future.cancel()
+            msg = "{} did not load within {}s."
+            LOGGER.warning(msg.format(name, STAVE_TIMEOUT))
 
     @abc.abstractproperty
     def _plot(self):
@@ -251,16 +427,29 @@ class StreamingScore(Score):
             self.s_start, self.s_end = _qrange(self.start, self.end,
                                                res="string")
             self._start.value, self._end.value = self.s_start, self.s_end
-            self.update_staves({'time_range': (self.start, self.end)})
+            # The staves tailing their device only get the new records
+            staves = {}
+            for name, stave in self.staves.items():
+                if not stave.stream_tail(self.start, self.end):
+                    stave.update_time_range(self.start, self.end)
+                    staves[name] = stave
+            if staves:
+                self.load_staves(staves)
 
         def stream():
             if self._stream.label == "► Play":
                 self._stream.label = "❚❚ Pause"
-                frq = 1000 * pd.Timedelta(self._freq.value).seconds
-                curdoc().add_periodic_callback(streaming_update, frq)
+                interval = pd.Timedelta(self._freq.value).total_seconds()
+                interval = max(strm.MIN_INTERVAL, interval)
+                for stave in self.staves.values():
+                    stave.start_streaming(interval)
+                curdoc().add_periodic_callback(streaming_update,
+                                               int(1000 * interval))
             else:
                 self._stream.label = "► Play"
                 curdoc().remove_periodic_callback(streaming_update)
+                for stave in self.staves.values():
+                    stave.stop_streaming()
 
         self._stream = Button(label="► Play")
         self._stream.on_click(stream)
@@ -284,11 +473,19 @@ class PressProdScore(Score):
         self._plot()
 
     def _plot(self):
-        _kw = {'mac': self._mac.value, 'start': self.start, 'end': self.end}
-        self.staves[ACCEL] = stv.PressProdStave(ACCEL, **_kw)
+        mac = self._mac.value
+        self._prepare({'thresholds': partial(ass.device_thresholds, mac)},
+                      self._build)
+
+    def _build(self, loaded):
+        _kw = {'mac': self._mac.value, 'start': self.start, 'end': self.end,
+               'lazy': True}
+        self.staves[ACCEL] = stv.PressProdStave(
+            ACCEL, threshold=loaded['thresholds'][ACCEL].high, **_kw)
         self.staves['pressprod'] = stv.CycleStave('pressprod', **_kw)
-        self.staves['pressprod'].fig.x_range = self.staves[ACCEL].fig.x_range
+        self.staves['pressprod'].share_x_range(self.staves[ACCEL])
         self.plots.children = [stave.plot for stave in self.staves.values()]
+        self.load_staves(self.staves)
 
 
 class ConditionScore(Score):
@@ -301,29 +498,36 @@ class ConditionScore(Score):
     def __call__(self):
         super().__call__()
         self.features = [ACCEL, 'velocity_x', 'velocity_y', 'velocity_z']
-        th = env.Device[self._mac.value].specs['thresholds']
-        self.thresholds = {k: [v.high, v.med, v.low] for k, v in th.items()
-                           if k in self.features}
-        self.thresholds['index'] = ['high', 'med', 'low']
-        self.thresh_source = ColumnDataSource(self.thresholds)
+        self.thresholds = {'index': ['high', 'med', 'low']}
+        self.thresh_source = None
         self._plot()
 
     def _plot(self):
         self.plots.children = [self.spinner]
-        th = env.Device[self._mac.value].specs['thresholds']
+        mac = self._mac.value
+        self._prepare({'thresholds': partial(ass.device_thresholds, mac)},
+                      self._build)
+
+    def _build(self, loaded):
+        th = loaded['thresholds']
         self.thresholds.update({k: [v.high, v.med, v.low]
                                 for k, v in th.items() if k in self.features})
-        self.thresh_source.data.update(self.thresholds)
-        _kw = {'mac': self._mac.value, 'start': self.start, 'end': self.end}
+        if self.thresh_source is None:
+            self.thresh_source = ColumnDataSource(self.thresholds)
+        else:
+            self.thresh_source.data.update(self.thresholds)
+        _kw = {'mac': self._mac.value, 'start': self.start, 'end': self.end,
+               'lazy': True}
         for ft in self.features:
             self.staves[ft] = stv.ConditionStave(ft, self.thresh_source, **_kw)
-            self.staves[ft].fig.x_range = self.staves[ACCEL].fig.x_range
+            self.staves[ft].share_x_range(self.staves[ACCEL])
         self.staves['condition'] = stv.AssessmentStave(self, 'condition',
                                                        **_kw)
-        self.staves['condition'].fig.x_range = self.staves[ACCEL].fig.x_range
+        self.staves['condition'].share_x_range(self.staves[ACCEL])
         # We want the assessment to appear on top
         self.plots.children = [self.staves[el].plot
                                for el in ['condition'] + self.features]
+        self.load_staves(self.staves)
 
 
 class SummaryScore(Score):
@@ -333,7 +537,8 @@ class SummaryScore(Score):
         super().__init__(title, *args, **kwargs)
         self.summary_range = Select(value=self.summaries[0],
                                     options=self.summaries)
-        self.summary_range.on_change('value', self._update_summary_range)
+        self.summary_range.on_change('value', self._profiled(
+            self._update_summary_range, '_update_summary_range'))
 
     def __call__(self):
         super().__call__()
@@ -353,15 +558,12 @@ class FeatureSummaryScore(SummaryScore):
 
     def _plot(self):
         self.plots.children = [self.spinner]
-        self.data = sequence(self._mac.value, self.summary_range.value,
-                             start=self.start, end=self.end)
-
-        self.staves = {}
-        _kw = {'data': self.data,
-               'score': self,
-               'start': self.start,
-               'end': self.end}
-
+        mac, start, end = self._mac.value, self.start, self.end
+        # The summaries are requested concurrently (the features in
+        # 'summary_10s' being loaded by the staves).
+        loads = {'device': lambda: env.Device[mac],
+                 'data': partial(sequence, mac, self.summary_range.value,
+                                 start=start, end=end)}
         if self.summary_range.value != 'summary_10s':
             mapper = {'summary_1m': 'summary_10s',
                       'summary_5m': 'summary_10s',
@@ -370,17 +572,33 @@ class FeatureSummaryScore(SummaryScore):
                       'summary_1D': 'summary_5m',
                       'summary_7D': 'summary_30m'}
             self.summary_feat = mapper[self.summary_range.value]
-            self.data_feat = sequence(self._mac.value, self.summary_feat,
-                                      start=self.start, end=self.end)
+            loads['data_feat'] = partial(sequence, mac, self.summary_feat,
+                                         start=start, end=end)
+        self._prepare(loads, self._build)
+
+    def _build(self, loaded):
+        self.device = loaded['device']
+        self.data = loaded['data']
+
+        self.staves = {}
+        _kw = {'data': self.data,
+               'score': self,
+               'mac': self._mac.value,
+               'start': self.start,
+               'end': self.end,
+               'lazy': True}
+
+        if 'data_feat' in loaded:
+            self.data_feat = loaded['data_feat']
             _kw['data_feat'] = self.data_feat
 
-        self.device = env.Device[self._mac.value]
         for feature in self.device.features:
             f0 = self.device.features[0]
             _kw['feature'] = feature
             self.staves[feature] = stv.FeatureSummaryStave(feature, **_kw)
-            self.staves[feature].fig.x_range = self.staves[f0].fig.x_range
+            self.staves[feature].share_x_range(self.staves[f0])
         self.plots.children = [stave.plot for stave in self.staves.values()]
+        self.load_staves(self.staves)
 
     def refresh_plot(self):
         self.summary_range.value = get_feature_range_from(self.start, self.end)
@@ -393,35 +611,63 @@ class MetricSummaryScore(SummaryScore):
         self.mac = '88:4A:EA:69:E1:59'
         self.summaries = METRIC_SUMMARIES
         super().__init__(title, *args, **kwargs)
+        self.heatmap_bins = Select(title='Production bins',
+                                   value=HEATMAP_BINS[0],
+                                   options=HEATMAP_BINS)
+        self.heatmap_bins.on_change('value', self._update_heatmap_bins)
+
+    def __call__(self):
+        super().__call__()
+        self.panel.children[0].children.append(self.heatmap_bins)
+
+    def _bins(self):
+        value = self.heatmap_bins.value
+        return None if value == HEATMAP_BINS[0] else value
+
+    def _update_heatmap_bins(self, attr, old, new):
+        stave = self.staves.get('pressprod')
+        if stave is not None:
+            stave.bins = self._bins()
+            stave.reload()
 
     def _plot(self):
         self.plots.children = [self.spinner]
-        self.data = sequence(self._mac.value, self.summary_range.value,
-                             start=self.start, end=self.end)
+        mapper = {'MetricSummary5m': 'summary_10s',
+                  'MetricSummary30m': 'summary_10s',
+                  'MetricSummaryS1': 'summary_10s',
+                  'MetricSummaryS2': 'summary_10s',
+                  'MetricSummaryS3': 'summary_10s',
+                  'MetricSummary1D': 'summary_5m',
+                  'MetricSummary1M': 'summary_6H'}
+        mac, start, end = self._mac.value, self.start, self.end
+        loads = {'data': partial(sequence, mac, self.summary_range.value,
+                                 start=start, end=end)}
+        if end - start > pd.Timedelta(2, 'h'):
+            self.summary_feat = mapper[self.summary_range.value]
+            loads['data_feat'] = partial(sequence, mac, self.summary_feat,
+                                         start=start, end=end)
+        else:
+            loads['thresholds'] = partial(ass.device_thresholds, mac)
+        self._prepare(loads, self._build)
+
+    def _build(self, loaded):
+        self.data = loaded['data']
         self.staves = {}
         _kw = {'mac': self._mac.value,
                'score': self,
                'start': self.start,
-               'end': self.end}
-
-        if self.end - self.start > pd.Timedelta(2, 'h'):
-            mapper = {'MetricSummary5m': 'summary_10s',
-                      'MetricSummary30m': 'summary_10s',
-                      'MetricSummaryS1': 'summary_10s',
-                      'MetricSummaryS2': 'summary_10s',
-                      'MetricSummaryS3': 'summary_10s',
-                      'MetricSummary1D': 'summary_5m',
-                      'MetricSummary1M': 'summary_6H'}
-            self.summary_feat = mapper[self.summary_range.value]
-            self.data_feat = sequence(self._mac.value,
-                                      self.summary_feat,
-                                      start=self.start,
-                                      end=self.end)
+               'end': self.end,
+               'lazy': True}
+
+        if 'data_feat' in loaded:
+            self.data_feat = loaded['data_feat']
             _kw['data'] = self.data_feat
             self.staves[ACCEL] = stv.FeatureSummaryStave(ACCEL, **_kw)
             self.staves[ACCEL].fig.plot_height = 300
         else:
-            self.staves[ACCEL] = stv.PressProdStave(ACCEL, **_kw)
+            threshold = loaded['thresholds'][ACCEL].high
+            self.staves[ACCEL] = stv.PressProdStave(ACCEL, threshold=threshold,
+                                                    **_kw)
             self.staves[ACCEL].fig.plot_height = 300
         _kw['data'] = self.data
 
@@ -445,15 +691,156 @@ class MetricSummaryScore(SummaryScore):
         to_show = {'pressprod': {'connectivity', 'activity', 'pressprod'},
                    'vibrations': {'connectivity', 'condition'}}
 
-        self.device = env.Device[self._mac.value]
-        for f in set(CC.keys()) & to_show[self.device.function]:
+        function = INVENTORY.get(self._mac.value)['function']
+        for f in set(CC.keys()) & to_show[function]:
             if f == 'pressprod':
-                self.staves[f] = stv.HeatMapStave('production_count', **_kw)
+                self.staves[f] = stv.HeatMapStave('production_count',
+                                                  bins=self._bins(), **_kw)
             else:
                 self.staves[f] = stv.StackedPercentageStave(f, cc=CC[f], **_kw)
-            self.staves[f].fig.x_range = self.staves[ACCEL].fig.x_range
+            self.staves[f].share_x_range(self.staves[ACCEL])
         self.plots.children = [stave.plot for stave in self.staves.values()]
+        self.load_staves(self.staves)
 
     def refresh_plot(self):
         self.summary_range.value = get_metric_range_from(self.start, self.end)
         self._plot()
+
+
+class ComparisonScore(Score):
+    """Class to compare a feature between devices, or between periods of a
+    device (the ones of the toolbar being the reference)."""
+    def __init__(self, title, *args, **kwargs):
+        super().__init__(title, *args, **kwargs)
+        self._feature = Select(title="Feature:", value=ACCEL, options=[ACCEL])
+        self._others = TextInput(title="Compare with (devices or macs):")
+        self._periods = TextInput(title="And with (e.g. 1D, 7D) before:")
+        self._compare = Button(label="Compare")
+        self._compare.on_click(self.update_comparison)
+
+    def __call__(self):
+        super().__call__()
+        self.panel.children.append(widgetbox([self._feature,
+                                              self._others,
+                                              self._periods,
+                                              self._compare]))
+        self._plot()
+
+    def update_comparison(self, *args, **kwargs):
+        self._plot()
+
+    def _series(self):
+        """The (mac, offset, name) to compare, the reference first."""
+        mac = self._mac.value
+        name = INVENTORY.get(mac)['device']
+        series = [(mac, pd.Timedelta(0), name)]
+        for other in filter(None, map(str.strip,
+                                      self._others.value.split(','))):
+            record = INVENTORY.get(other) or INVENTORY.find_device(other)
+            if record is None:
+                LOGGER.warning("Unknown device: {}".format(other))
+                continue
+            series.append((record['mac'], pd.Timedelta(0),
+                           record['device']))
+        for period in filter(None, map(str.strip,
+                                       self._periods.value.split(','))):
+            try:
+                offset = pd.Timedelta(period)
+            except ValueError:
+                LOGGER.warning("Invalid period: {}".format(period))
+                continue
+            series.append((mac, offset, "{} (-{})".format(name, period)))
+        return series
+
+    def _plot(self):
+        self.plots.children = [self.spinner]
+        mac = self._mac.value
+        self._prepare({'features': lambda: list(env.Device[mac].features)},
+                      self._build)
+
+    def _build(self, loaded):
+        features = loaded['features']
+        self._feature.options = features
+        if self._feature.value not in features:
+            self._feature.value = features[0]
+        _kw = {'mac': self._mac.value, 'start': self.start, 'end': self.end,
+               'lazy': True}
+        self.staves = {'comparison': stv.ComparisonStave(
+            self._feature.value, self._series(), **_kw)}
+        self.plots.children = [self.staves['comparison'].plot]
+        self.load_staves(self.staves)
+
+
+class FleetScanScore(Score):
+    """Class to rank the devices of a function against their thresholds."""
+    def __init__(self, title, *args, **kwargs):
+        super().__init__(title, *args, **kwargs)
+        self._results, self._total = [], 0
+
+    def _init_toolbar(self):
+        functions = sorted({r['function'] for r in INVENTORY.devices()})
+        function = 'vibrations' if 'vibrations' in functions else \
+            functions[0]
+        self._function = Select(title="Function:", value=function,
+                                options=functions)
+        self._label = Select(title="Summary:", value=FEATURE_SUMMARIES[-1],
+                             options=FEATURE_SUMMARIES)
+        self._scan = Button(label="Scan")
+        self._scan.on_click(self.update_scan)
+        self._progress = Div(text='')
+        self.toolbar.children.append(row(self.logo,
+                                         self._function,
+                                         self._label,
+                                         widgetbox(self._scan,
+                                                   self._progress)))
+        number = NumberFormatter(format='0.00')
+        columns = [TableColumn(field=c, title=c, formatter=number)
+                   if c in fl.NUMERIC else TableColumn(field=c, title=c)
+                   for c in fl.COLUMNS]
+        self.source = ColumnDataSource({c: [] for c in fl.COLUMNS})
+        self.table = DataTable(source=self.source, columns=columns,
+                               width=1200, height=600)
+        self._plot()
+
+    def _plot(self):
+        self.plots.children = [self.table]
+
+    def refresh_plot(self):
+        self._label.value = get_feature_range_from(self.start, self.end)
+
+    def update_scan(self, *args, **kwargs):
+        """Scan the devices of the function, the results being added to the
+        table as they come, then ranked once they are all there."""
+        for future in self._pending.values():
+            future.cancel()
+        futures = fl.scan(self._label.value, self.start, self.end,
+                          self._function.value)
+        self._pending = {('scan', i): f for i, f in enumerate(futures)}
+        self._results, self._total = [], len(futures)
+        self._started = time.time()
+        self.source.data = {c: [] for c in fl.COLUMNS}
+        self._progress.text = "Scanning {} devices...".format(self._total)
+        doc = curdoc()
+        for key, future in list(self._pending.items()):
+            if doc.session_context is None:
+                self._scanned(key, future)
+                continue
+            callback = partial(self._scanned, key, future)
+            future.add_done_callback(
+                lambda f, cb=callback: doc.add_next_tick_callback(cb))
+
+    def _scanned(self, key, future):
+        if self._pending.get(key) is not future:
+            return
+        del self._pending[key]
+        res = future.result()
+        self._results.append(res)
+        self.source.stream({c: np.array([res[c]]) for c in fl.COLUMNS})
+        if len(self._results) < self._total:
+            self._progress.text = "{}/{} devices scanned".format(
+                len(self._results), self._total)
+            return
+        df = fl.rank(self._results)
+        self.source.data = {c: df[c].values for c in fl.COLUMNS}
+        self._progress.text = "{} devices scanned in {:.1f}s".format(
+            self._total, time.time() - self._started)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The bokeh server hosting every score: one application per score, and a new
+score for every session.
+"""
+# ===================================================================
+# Imports
+# ===================================================================
+
+import os
+import time
+from functools import partial
+from threading import Thread
+
+from bokeh.application import Application
+from bokeh.application.handlers import Handler
+from bokeh.models.widgets import Div
+from bokeh.server.server import BaseServer
+from bokeh.server.tornado import BokehTornado
+from bokeh.server.util import bind_sockets
+
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+import tzigane.profiling as prf
+from tzigane import LOGGER
+from tzigane.inventory import INVENTORY
+
+# Sessions beyond this number get a 'busy' page instead of a score.
+MAX_SESSIONS = int(os.environ.get('TZIGANE_MAX_SESSIONS', 20))
+# Sessions whose browser tab was closed are destroyed after this time (ms).
+UNUSED_SESSION_LIFETIME = int(os.environ.get('TZIGANE_SESSION_LIFETIME',
+                                             60000))
+CHECK_UNUSED_SESSIONS = 15000
+# Sessions without any change from their browser for this time (ms) are
+# closed, even if their tab is still open.
+IDLE_SESSION_LIFETIME = int(os.environ.get('TZIGANE_IDLE_LIFETIME',
+                                           30 * 60000))
+CHECK_IDLE_SESSIONS = 60000
+# Period (in ms) at which a session checks whether the inventory is ready.
+INVENTORY_RETRY = 1000
+
+BUSY = """<br><br><div style="text-align:center;">
+<img src="../static/logo1.png" width="200"><br><br>
+Too many dashboards are open at the moment, please retry later.</div>
+"""
+WAITING = """<br><br><div style="text-align:center;">
+<img src="../static/logo1.png" width="200"><br><br>
+Loading the devices...</div>
+"""
+IDLE = """<br><br><div style="text-align:center;">
+<img src="../static/logo1.png" width="200"><br><br>
+This dashboard was closed after a period of inactivity, please reload the
+page.</div>
+"""
+
+# ===================================================================
+# Helper function
+# ===================================================================
+
+
+def flag(arguments, name):
+    """Helper function that returns whether a flag (e.g. ?debug=1) is set
+    in the arguments of a session request."""
+    values = arguments.get(name)
+    return bool(values) and values[-1] not in (b'', b'0', b'false')
+
+
+# ===================================================================
+# Class definitions
+# ===================================================================
+
+
+class ScoreHandler(Handler):
+    """Creates a new score of the given type for every session. The score
+    is created on the IOLoop shared by all the sessions: until the inventory
+    is ready, the session shows a 'loading' page and retries every
+    INVENTORY_RETRY ms instead of waiting for it (it counts against
+    MAX_SESSIONS meanwhile)."""
+    def __init__(self, server, title, score_type):
+        super().__init__()
+        self.server, self.title, self.score_type = server, title, score_type
+
+    def modify_document(self, doc):
+        doc.title = self.title
+        if len(self.server.sessions) >= MAX_SESSIONS:
+            LOGGER.warning("Session limit reached ({})".format(MAX_SESSIONS))
+            doc.add_root(Div(text=BUSY))
+            return
+        session_id = doc.session_context.id
+        self.server.sessions[session_id] = {'title': self.title,
+                                            'score': None, 'doc': doc,
+                                            'created': time.time(),
+                                            'active': time.time()}
+        doc.on_change(partial(self.server.touch, session_id))
+        self._create(doc)
+
+    def _create(self, doc):
+        session = self.server.sessions.get(doc.session_context.id)
+        if session is None:
+            # Closed while waiting for the inventory
+            return
+        if not INVENTORY.ready.is_set():
+            if not doc.roots:
+                doc.add_root(Div(text=WAITING))
+            doc.add_timeout_callback(partial(self._create, doc),
+                                     INVENTORY_RETRY)
+            return
+        doc.clear()
+        args = doc.session_context.request.arguments
+        score = self.score_type(self.title, debug=flag(args, 'debug'),
+                                profile=flag(args, 'profile') or prf.PROFILE)
+        score.doc = doc
+        score()
+        doc.add_root(score.layout)
+        session['score'] = score
+
+    def on_session_destroyed(self, session_context):
+        self.server.release(session_context.id)
+
+
+class ScoreServer:
+    """A single, long-lived bokeh server hosting the applications of all the
+    scores (at /<title>), running its own IOLoop in a thread. The sessions
+    idle for IDLE_SESSION_LIFETIME ms are closed, so that the tabs left open
+    do not hold the MAX_SESSIONS slots."""
+    def __init__(self, scores, port=0, address='127.0.0.1',
+                 origins=("localhost:8000",)):
+        self.scores = scores
+        self.address, self.port = address, port
+        self.origins = list(origins)
+        self.sessions = {}
+        self.server = None
+
+    def __contains__(self, title):
+        return title in self.scores
+
+    def url(self, title, host='localhost'):
+        return 'http://{}:{}/{}'.format(host, self.port, title)
+
+    def start(self):
+        """Bind the sockets and start the IOLoop thread."""
+        apps = {'/' + title: Application(ScoreHandler(self, title, score))
+                for title, score in self.scores.items()}
+        bokeh_tornado = BokehTornado(
+            apps, extra_websocket_origins=self.origins,
+            check_unused_sessions_milliseconds=CHECK_UNUSED_SESSIONS,
+            unused_session_lifetime_milliseconds=UNUSED_SESSION_LIFETIME)
+        bokeh_http = HTTPServer(bokeh_tornado)
+        sockets, self.port = bind_sockets(self.address, self.port)
+        bokeh_http.add_sockets(sockets)
+        LOGGER.info("Bokeh server listening on port {}".format(self.port))
+
+        def bk_worker():
+            # The sockets were added to the global IOLoop
+            io_loop = IOLoop.instance()
+            self.server = BaseServer(io_loop, bokeh_tornado, bokeh_http)
+            self.server.start()
+            PeriodicCallback(self.close_idle, CHECK_IDLE_SESSIONS,
+                             io_loop=io_loop).start()
+            self.server.io_loop.start()
+
+        Thread(target=bk_worker, daemon=True).start()
+        return self
+
+    def touch(self, session_id, event):
+        """Record the changes coming from the browser of a session (the
+        ones of the server have no setter)."""
+        session = self.sessions.get(session_id)
+        if session is not None and getattr(event, 'setter', None) is not None:
+            session['active'] = time.time()
+
+    def close_idle(self):
+        """Close the sessions idle for IDLE_SESSION_LIFETIME ms: their score
+        is released and replaced by a page asking to reload."""
+        limit = time.time() - IDLE_SESSION_LIFETIME / 1000
+        for session_id, session in list(self.sessions.items()):
+            if session['active'] < limit:
+                doc = session['doc']
+                self.release(session_id, 'idle')
+                doc.add_next_tick_callback(partial(self._show_idle, doc))
+
+    @staticmethod
+    def _show_idle(doc):
+        doc.clear()
+        doc.add_root(Div(text=IDLE))
+
+    def release(self, session_id, reason='destroyed'):
+        """Forget the score of a destroyed (or idle) session."""
+        try:
+            session = self.sessions.pop(session_id)
+        except KeyError:
+            return
+        if session['score'] is not None:
+            session['score'].close()
+        msg = "Session of {} {} after {:.0f}s ({} open)"
+        LOGGER.info(msg.format(session['title'], reason,
+                               time.time() - session['created'],
+                               len(self.sessions)))
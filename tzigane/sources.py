@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Backends of sequence() and of the inventory. The dataforge backend is
+defined in tzigane.util; this module defines their interface and a local
+one, reading Parquet files partitioned per mac, label and day:
+
+    <root>/<label>/<mac>/<YYYY-MM-DD>.parquet
+    <root>/inventory.json
+
+The files hold a utc 'timestamp' column, along with the columns of the
+label (a 'state' column, the state entered at the timestamp, for the
+transition logs).
+
+Backends can also be recorded to an archive, which can then be replayed.
+"""
+# ===================================================================
+# Imports
+# ===================================================================
+
+import os
+import abc
+import glob
+import gzip
+import json
+import time
+import pickle
+import hashlib
+import threading
+from collections import namedtuple
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from tzigane import LOGGER
+
+# Labels read from transition logs: their rows are states, which last until
+# the next row.
+STATE_LABELS = ['activity', 'condition', 'connectivity', 'pressprod']
+STATE_COLORS = {'off': 'lightgrey', 'idle': 'lightblue',
+                'operating': 'lightgreen', 'producing': 'lightgreen',
+                'warning': 'orange', 'critical': 'red',
+                'connected': 'lightgreen', 'disconnected': 'lightgrey'}
+# Number of days looked back for the state preceding a range.
+LOOKBACK_DAYS = int(os.environ.get('TZIGANE_PARQUET_LOOKBACK', 7))
+# Rows per row group of the written files, the unit of predicate pushdown.
+ROW_GROUP = 65536
+
+Highlight = namedtuple('Highlight', ['lower', 'upper'])
+Highlighter = namedtuple('Highlighter', ['plargs'])
+
+# ===================================================================
+# Helper function
+# ===================================================================
+
+
+def _bounds(keyrange):
+    """Helper function that returns the bounds of a time range, either an
+    anaximander interval or a (lower, upper) tuple."""
+    if hasattr(keyrange, 'lower'):
+        return keyrange.lower, keyrange.upper
+    return keyrange
+
+
+def _call_file(args):
+    """Helper function that returns the file name of a recorded call."""
+    return hashlib.sha1(repr(args).encode()).hexdigest() + '.pkl.gz'
+
+
+def _days(start, end):
+    """Helper function that returns the days overlapping [start, end]."""
+    return pd.date_range(start.floor('D'), end, freq='D')
+
+
+# ===================================================================
+# Class definitions
+# ===================================================================
+
+
+class DataSource(abc.ABC):
+    """Interface of the backends. Frames have the attributes of the dataforge
+    frames used by tzigane: data (a timestamp-indexed DataFrame), keyrange,
+    empty, unique (the state before the range of an empty state frame) and
+    as_digest() for the state tables. The tiles of the cache are fetched
+    one by one from the sources whose calls must not depend on what the
+    cache holds (per_tile)."""
+    name = 'source'
+    per_tile = False
+
+    @abc.abstractmethod
+    def fetch(self, mac, label, start, end, maxrows=None, maxraise=None,
+              check_status=True):
+        """The frame of the label over [start, end], along with the time up
+        to which it is complete."""
+
+    @abc.abstractmethod
+    def devices(self):
+        """Records of the devices (see tzigane.inventory.FIELDS)."""
+
+
+class LocalFrame:
+    """Frame of a local backend."""
+    def __init__(self, data, start, end, unique=None):
+        self.data = data
+        self.keyrange = {'timestamp': (start, end)}
+        self.unique = unique
+
+    def __copy__(self):
+        # The keyrange of the copies is set by tzigane.util._merge
+        return LocalFrame(self.data, *_bounds(self.keyrange['timestamp']),
+                          unique=self.unique)
+
+    @property
+    def empty(self):
+        return self.data.empty
+
+    def as_digest(self):
+        return LocalDigest(self)
+
+
+class LocalDigest:
+    """Highlights of the states of a LocalFrame, with the methods of the
+    anaximander HighlightDigest used by tzigane.intervals."""
+    def __init__(self, frame):
+        start, end = _bounds(frame.keyrange['timestamp'])
+        states = frame.data['state'] if 'state' in frame.data.columns \
+            else pd.Series([], index=pd.DatetimeIndex([], tz='utc'))
+        if frame.unique is not None and (states.empty or
+                                         states.index[0] > start):
+            head = pd.Series([frame.unique], index=pd.DatetimeIndex([start]))
+            states = pd.concat([head, states])
+        self.states = states
+        self.upper = list(states.index[1:]) + [end]
+
+    def shades(self):
+        return sorted(set(self.states.values))
+
+    def highlighter_type(self, shade):
+        return Highlighter({'color': STATE_COLORS.get(shade, 'grey')})
+
+    def highlights(self, shade):
+        return [Highlight(lower, upper) for lower, upper, state
+                in zip(self.states.index, self.upper, self.states.values)
+                if state == shade]
+
+
+class ParquetSource(DataSource):
+    """Local backend reading the Parquet files of a directory (see above).
+    Only the row groups overlapping the range are read."""
+    name = 'parquet'
+
+    def __init__(self, root):
+        self.root = root
+        self._empty = {}
+
+    def _path(self, mac, label, day):
+        return os.path.join(self.root, label, mac,
+                            day.strftime('%Y-%m-%d') + '.parquet')
+
+    def _empty_frame(self, label):
+        """An empty frame with the columns (and dtypes) of the label, read
+        from the schema of any of its files (without columns if there is
+        none yet)."""
+        if label not in self._empty:
+            paths = glob.glob(os.path.join(self.root, label, '*', '*.parquet'))
+            df = pq.read_schema(paths[0]).empty_table().to_pandas() \
+                if paths else pd.DataFrame(columns=['timestamp'])
+            df.index = pd.DatetimeIndex([], tz='utc', name='timestamp')
+            self._empty[label] = df.drop(columns='timestamp')
+        return self._empty[label].copy()
+
+    def _read(self, mac, label, days, filters):
+        frames = []
+        for day in days:
+            path = self._path(mac, label, day)
+            if os.path.exists(path):
+                frames.append(pd.read_parquet(path, filters=filters))
+        if not frames:
+            return self._empty_frame(label)
+        return pd.concat(frames).set_index('timestamp').sort_index()
+
+    def _previous(self, mac, label, start):
+        """The last state entered before start (None if there is none within
+        LOOKBACK_DAYS)."""
+        for day in reversed(_days(start - pd.Timedelta(LOOKBACK_DAYS, 'D'),
+                                  start)):
+            df = self._read(mac, label, [day],
+                            [('timestamp', '<', start)])
+            if not df.empty:
+                return df['state'].iloc[-1]
+        return None
+
+    def fetch(self, mac, label, start, end, maxrows=None, maxraise=None,
+              check_status=True):
+        filters = [('timestamp', '>=', start), ('timestamp', '<=', end)]
+        df = self._read(mac, label, _days(start, end), filters)
+        if maxrows is not None and len(df) > maxrows:
+            if maxraise:
+                msg = "{} rows of {} for {} from {} to {}, more than {}."
+                raise ValueError(msg.format(len(df), label, mac, start, end,
+                                            maxrows))
+            df = df.iloc[:maxrows]
+        unique = None
+        if label in STATE_LABELS and (df.empty or df.index[0] > start):
+            unique = self._previous(mac, label, start)
+        return (LocalFrame(df, start, end, unique=unique),
+                pd.Timestamp('now', tz='utc'))
+
+    def devices(self):
+        with open(os.path.join(self.root, 'inventory.json')) as f:
+            return json.load(f)
+
+    def write(self, mac, label, df):
+        """Write a timestamp-indexed frame, one file per day (replacing the
+        files of these days)."""
+        df = df.copy()
+        df.index = pd.DatetimeIndex(df.index, name='timestamp')
+        if df.index.tz is None:
+            df.index = df.index.tz_localize('utc')
+        for day, part in df.groupby(df.index.floor('D')):
+            path = self._path(mac, label, day)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            part.sort_index().reset_index().to_parquet(
+                path, index=False, row_group_size=ROW_GROUP)
+
+    def write_devices(self, records):
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, 'inventory.json'), 'w') as f:
+            json.dump(list(records), f)
+
+
+class RecordingSource(DataSource):
+    """Backend recording the calls to another one (arguments, frame or
+    error, latency) in an archive directory: one gzipped pickle per call,
+    along with the inventory and the time the ranges were computed from
+    (`now`, which should be pinned while recording)."""
+    per_tile = True
+
+    def __init__(self, source, path, now=None):
+        self.source, self.path = source, path
+        self.name = 'recording ' + source.name
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({'source': source.name,
+                       'now': None if now is None else str(now)}, f)
+
+    def _write(self, name, record):
+        path = os.path.join(self.path, name)
+        tmp = path + '.{}.{}.tmp'.format(os.getpid(), threading.get_ident())
+        with gzip.open(tmp, 'wb') as f:
+            pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def fetch(self, mac, label, start, end, maxrows=None, maxraise=None,
+              check_status=True):
+        args = (mac, label, start, end, maxrows, maxraise, check_status)
+        record = {'args': args, 'value': None, 'error': None}
+        started = time.time()
+        try:
+            record['value'] = self.source.fetch(*args)
+        except Exception as e:
+            record['error'] = e
+            raise
+        finally:
+            record['latency'] = time.time() - started
+            self._record(_call_file(args), record)
+        return record['value']
+
+    def _record(self, name, record):
+        """Write the record of a call, without failing it: an error that
+        cannot be pickled is recorded as a RuntimeError, and a value that
+        cannot be is not recorded."""
+        try:
+            self._write(name, record)
+            return
+        except Exception as e:
+            if record['error'] is None:
+                LOGGER.warning("Cannot record {}: {}".format(
+                    record['args'], e))
+                return
+        record['error'] = RuntimeError(str(record['error']))
+        try:
+            self._write(name, record)
+        except Exception as e:
+            LOGGER.warning("Cannot record {}: {}".format(record['args'], e))
+
+    def devices(self):
+        records = self.source.devices()
+        self._write('devices.pkl.gz', records)
+        return records
+
+
+class ReplaySource(DataSource):
+    """Backend serving the calls recorded by a RecordingSource, after the
+    recorded latency multiplied by `latency` (0 to serve them right away).
+    """
+    name = 'replay'
+    per_tile = True
+
+    def __init__(self, path, latency=0.):
+        self.path, self.latency = path, latency
+        with open(os.path.join(self.path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.now = None if meta['now'] is None else pd.Timestamp(meta['now'])
+
+    def _read(self, name):
+        with gzip.open(os.path.join(self.path, name), 'rb') as f:
+            return pickle.load(f)
+
+    def fetch(self, mac, label, start, end, maxrows=None, maxraise=None,
+              check_status=True):
+        args = (mac, label, start, end, maxrows, maxraise, check_status)
+        try:
+            record = self._read(_call_file(args))
+        except OSError:
+            msg = "No recorded query of {} for {} from {} to {}."
+            raise LookupError(msg.format(label, mac, start, end))
+        if self.latency:
+            time.sleep(self.latency * record['latency'])
+        if record['error'] is not None:
+            raise record['error']
+        return record['value']
+
+    def devices(self):
+        return self._read('devices.pkl.gz')
@@ -7,24 +7,47 @@ The basic classes are defined in this file.
 # Imports
 # ===================================================================
 
+import os
 import abc
 import logging
+import time
+import numpy as np
 import pandas as pd
-import dataforge.condition as cnd
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from bokeh.io import curdoc
 import dataforge.environment as env
-from tzigane.util import _qrange, sequence
+import tzigane.assessment as ass
+import tzigane.intervals as ivl
+import tzigane.metrics as mtr
+import tzigane.quads as qd
+import tzigane.sampling as smp
+import tzigane.streaming as strm
+from tzigane.util import FEATURE_PERIODS, WORKERS, Debounce
+from tzigane.util import _qrange, _clip, resolution_for, sequence
 from anaximander.data.digest import HighlightDigest
 from bokeh.models import WheelZoomTool, BoxSelectTool, ColumnDataSource
 from bokeh.layouts import layout, widgetbox, row
-from bokeh.models.widgets import Button
+from bokeh.models.widgets import Button, DataTable, Div, NumberFormatter
+from bokeh.models.widgets import TableColumn
 from bokeh.plotting import figure
-from bokeh.models import Slider, HoverTool
-from bokeh.palettes import magma
+from bokeh.models import Slider, HoverTool, Range1d
+from bokeh.palettes import Category10, magma
 
 from tzigane.gadgets import Base, Gadget, hLine, hSlider, pFunction
 
 ACCEL = 'accel_energy_512'
 PALETTE = magma(40)[30:][::-1]
+# Rounding error allowed when comparing the x_range with the loaded range.
+TOLERANCE = pd.Timedelta(1, 'ms')
+# Number of rows of the summary table a stave is previewed from.
+PREVIEW_POINTS = 50
+# Number of points of the rolling correlations of the comparisons.
+CORRELATION_WINDOW = 60
+# Bounded pool querying the series of the comparisons (of all the sessions),
+# apart from WORKERS which runs the loads of the comparison staves.
+COMPARISON_WORKERS = ThreadPoolExecutor(int(os.environ.get(
+    'TZIGANE_COMPARISON_CONCURRENCY', 4)))
 
 
 # ===================================================================
@@ -32,14 +55,14 @@ PALETTE = magma(40)[30:][::-1]
 # ===================================================================
 
 
-class ADict(dict):
-    def __init__(self, *args, **kwargs):
-        super(ADict, self).__init__(*args, **kwargs)
-        self.__dict__ = self
-
-
 class Stave(Base):
-    """Class to gather all the elements for a plot."""
+    """Class to gather all the elements for a plot.
+    Staves with follow = True fetch what becomes visible when the x_range is
+    panned or zoomed (debounced). Lazy staves (lazy=True) fetch nothing
+    when they are created: the score loads them (cf. Score.load_staves),
+    and their gadgets are created on their first update."""
+    follow = False
+
     def __init__(self, title, *args, **kwargs):
         super().__init__()
         # Get arguments
@@ -47,23 +70,108 @@ class Stave(Base):
         self.mac = kwargs.setdefault('mac', None)
         self.start = kwargs.setdefault('start', None)
         self.end = kwargs.setdefault('end', None)
+        self.lazy = kwargs.setdefault('lazy', False)
 
         # Definition of the global layout
         self.fig = figure(plot_width=1200, x_axis_type='datetime',
                           tools='pan,box_zoom,reset', active_drag='pan',
                           title=self.title, name=self.title)
         self.gadgets = []
+        self._gadgets_ready = False
         self.tools = widgetbox(self.gadgets)
         self.plot = layout(row([self.fig, self.tools]))
+        self._reloading = None
+        self._debounced_follow = Debounce(self._follow_x_range)
+        self._watch_x_range()
 
     def init_stave(self):
         self._init_fig()
-        self._update_fig()
+        if not self.lazy:
+            self._update_fig()
         self.update_time_range(self.start, self.end)
-        self._init_gadgets()
-        self._update_gadgets()
+        if not self.lazy:
+            self._update_gadgets()
+
+    def share_x_range(self, stave):
+        """Use the x_range of another stave (to pan/zoom them together)."""
+        self.fig.x_range = stave.fig.x_range
+        self._watch_x_range()
+
+    def _watch_x_range(self):
+        if getattr(self, '_watched', None) is self.fig.x_range:
+            return
+        self._watched = self.fig.x_range
+        self.fig.x_range.on_change('start', self._on_x_range)
+        self.fig.x_range.on_change('end', self._on_x_range)
+
+    def _on_x_range(self, attr, old, new):
+        if self.follow:
+            self._debounced_follow()
+
+    def visible_range(self):
+        """Time range currently shown by the figure."""
+        start, end = self.fig.x_range.start, self.fig.x_range.end
+        if start is None or end is None:
+            return _qrange(self.start, self.end)
+        return _qrange(pd.Timestamp(start, unit='ms'),
+                       pd.Timestamp(end, unit='ms'))
+
+    def _covers(self, start, end):
+        """Whether the data already loaded is enough to show [start, end]."""
+        lower, upper = _qrange(self.start, self.end)
+        return lower - TOLERANCE <= start and end <= upper + TOLERANCE
+
+    def _follow_x_range(self):
+        start, end = self.visible_range()
+        lower, upper = _qrange(self.start, self.end)
+        # A range set by update_time_range is loaded by the score.
+        is_current = abs(start - lower) <= TOLERANCE and \
+            abs(end - upper) <= TOLERANCE
+        if is_current or self._covers(start, end):
+            self._refresh_view()
+        else:
+            self.start, self.end = start, end
+            self.reload()
+
+    def _refresh_view(self):
+        """Adapt what is shown to the visible range, without fetching."""
+        pass
+
+    def reload(self):
+        """Fetch the data on the worker pool, then render it on the document
+        thread (synchronously out of a session)."""
+        doc = curdoc()
+        self._reloading = future = WORKERS.submit(self._load)
+        if doc.session_context is None:
+            return self._reloaded(future)
+        future.add_done_callback(lambda f: doc.add_next_tick_callback(
+            partial(self._reloaded, f)))
+
+    def _reloaded(self, future):
+        if self._reloading is not future:
+            return
+        try:
+            self._render(future.result())
+            self._update_gadgets()
+        except Exception as e:
+            logging.exception(e)
+
+    def start_streaming(self, interval):
+        """Start tailing the new records every `interval` seconds. Returns
+        whether the stave can stream (see stream_tail)."""
+        return False
+
+    def stream_tail(self, start, end):
+        """Move to [start, end] with the records tailed since the last update.
+        Returns False if the stave has to be reloaded instead."""
+        return False
+
+    def stop_streaming(self):
+        pass
 
     def update_time_range(self, start, end):
+        # A reload of the previous range (e.g. after a pan) is superseded
+        self._reloading = None
         self.start, self.end = _qrange(start=start, end=end)
         self.fig.x_range.start = self.start.value / 1e6
         self.fig.x_range.end = self.end.value / 1e6
@@ -75,29 +183,69 @@ class Stave(Base):
              - definition of what to draw from the source."""
         pass
 
-    @abc.abstractproperty
+    @mtr.instrumented('stave_update_fig')
     def _update_fig(self):
-        """Contains:
-             - method to fetch the data,
-             - update the source (automatically updates the fig)"""
+        """Fetch the data and update the source (automatically updates the
+        fig)."""
+        self._render(self._load())
+
+    def _load(self):
+        """Contains the method to fetch the data. It may run outside of the
+        document thread (cf. Score.load_staves): it must not modify any
+        bokeh model."""
+        return None
+
+    def _stages(self):
+        """Loads rendered one after the other as they complete, from a quick
+        preview to the data of _load (which is the last one)."""
+        return [self._load]
+
+    @abc.abstractmethod
+    def _render(self, loaded):
+        """Update the source from what _load returned."""
         return NotImplemented
 
     def _init_gadgets(self):
         """List of all the gadgets to add to the stave."""
         self.gadgets = []
 
+    @mtr.instrumented('gadgets_update', source=False)
     def _update_gadgets(self):
-        """Update the gadgets (mainly update the time range)."""
+        """Update the gadgets (mainly update the time range). They are created
+        on the first update, once the data is there."""
+        if not self._gadgets_ready:
+            self._init_gadgets()
+            self._gadgets_ready = True
         for gadget in self.gadgets:
             gadget._update(start=self.start, end=self.end)
 
 
 class FeatureStave(Stave):
     """Class for the time series.
-    Warning: Please move the plot once if you want the time range to work."""
+    Warning: Please move the plot once if you want the time range to work.
+    The stave remembers the interval it holds (self.held over
+    self.held_range), so that moving the time range only fetches the
+    missing head/tail and streams it to the source (or the whole range,
+    stitched from the frame the head/tail was fetched against, when another
+    load replaced it in the meantime). The data comes from the
+    coarsest summary table that still gives a point per pixel (the min/max
+    envelope of each row), or from the raw feature otherwise. When the held
+    frame has more points than the figure has pixels, the source gets a
+    downsampled view of the visible range instead ('minmax' or 'lttb'
+    sampling), to which the tail of the moves forward (e.g. the streamed
+    records) is streamed, downsampled at the same resolution."""
+    follow = True
+
     def __init__(self, title, *args, **kwargs):
         super().__init__(title, *args, **kwargs)
         self.feature = kwargs.setdefault('feature', title)
+        self.sampling = kwargs.setdefault('sampling', 'minmax')
+        self.summaries = kwargs.setdefault('summaries', True)
+        self.held, self.held_range, self.held_label = None, None, None
+        self._mirror = False
+        # Range, and visible span, of the downsampled view along with the
+        # timestamps (ns) it has in the source
+        self._view, self._view_x = None, None
         self.init_stave()
 
     def _init_fig(self):
@@ -109,18 +257,236 @@ class FeatureStave(Stave):
                       self.feature,
                       source=self.source)
 
+    def _resolution(self, start, end):
+        """Summary table to read [start, end] from (None for the raw data)."""
+        if not self.summaries:
+            return None
+        return resolution_for(start, end, FEATURE_PERIODS,
+                              self.fig.plot_width)
+
+    def _query(self, start, end, label=None):
+        if label is not None:
+            try:
+                return self._query_summary(start, end, label)
+            except KeyError:
+                # The feature is not summarized
+                pass
+        frame = sequence(self.mac, self.feature, start=start, end=end)
+        return frame.data[[self.feature]]
+
+    def _query_summary(self, start, end, label):
+        """The min and max of each row of the summary, drawn as an envelope
+        (the max at the middle of the row)."""
+        df = sequence(self.mac, label, start=start, end=end).data
+        low = df[[self.feature + '_min']]
+        high = df[[self.feature + '_max']]
+        period = pd.Timedelta(dict(FEATURE_PERIODS)[label])
+        high.index = high.index + period / 2
+        low.columns = high.columns = [self.feature]
+        return pd.concat([low, high]).sort_index()
+
     def _update_fig(self):
-        self.data = sequence(self.mac, self.feature, start=self.start,
-                             end=self.end)
         try:
-            df = self.data.data[[self.feature]]
-            self.source.data = self.source.from_df(df)
+            super()._update_fig()
         except Exception as e:
+            self.held, self.held_range = None, None
             logging.exception(e)
 
+    def _covers(self, start, end):
+        if self.held_range is None or \
+                self._resolution(start, end) != self.held_label:
+            return False
+        lower, upper = self.held_range
+        return lower - TOLERANCE <= start and end <= upper + TOLERANCE
+
+    def _is_full(self, start, end, label):
+        """Whether [start, end] has to be loaded from scratch."""
+        held, held_range = self.held, self.held_range
+        return held is None or label != self.held_label or \
+            start >= held_range[1] or end <= held_range[0]
+
+    def _stages(self):
+        """When the whole range is loaded, the summary tables coarser than
+        the one of the range are loaded first, starting from the coarsest
+        giving PREVIEW_POINTS rows."""
+        start, end = _qrange(self.start, self.end)
+        label = self._resolution(start, end)
+        coarse = resolution_for(start, end, FEATURE_PERIODS, PREVIEW_POINTS)
+        if not self.summaries or coarse is None or coarse == label or \
+                not self._is_full(start, end, label):
+            return [self._load]
+        labels = [label_ for label_, period in FEATURE_PERIODS]
+        finest = labels.index(label) + 1 if label is not None else 0
+        previews = labels[finest:labels.index(coarse) + 1][::-1]
+        return [partial(self._preview, start, end, label_)
+                for label_ in previews] + \
+            [self._load]
+
+    def _preview(self, start, end, label):
+        return start, end, label, self._query(start, end, label), None, None
+
+    def _load(self):
+        """Fetch the whole range, or only what is missing on both sides of
+        the held interval when the new range overlaps it at the same
+        resolution. The held frame the head/tail is fetched against is
+        returned along with them (None for a whole range)."""
+        start, end = _qrange(self.start, self.end)
+        label = self._resolution(start, end)
+        held, held_range = self.held, self.held_range
+        if self._is_full(start, end, label):
+            return start, end, label, self._query(start, end, label), None, \
+                None
+        head = tail = None
+        if start < held_range[0]:
+            first = held.index[0] if not held.empty else held_range[0]
+            head = self._query(start, first, label)
+        if end > held_range[1]:
+            last = held.index[-1] if not held.empty else held_range[1]
+            tail = self._query(last, end, label)
+        return start, end, label, head, tail, held
+
+    @staticmethod
+    def _stitch(held, head, tail, start, end):
+        """The head, the part of held within [start, end] and the tail,
+        without the rows of head/tail that held already has."""
+        head = held.iloc[:0] if head is None else \
+            head[head.index < held.index[0]] if not held.empty else head
+        tail = held.iloc[:0] if tail is None else \
+            tail[tail.index > held.index[-1]] if not held.empty else tail
+        return head, _clip(held, start, end), tail
+
+    def _render(self, loaded):
+        start, end, label, head, tail, base = loaded
+        self.held_label = label
+        if base is not None and base is not self.held:
+            # Another load replaced the frame the head/tail was fetched
+            # against: the range is rendered as a whole.
+            head = pd.concat(self._stitch(base, head, tail, start, end))
+            base = None
+        if base is None:
+            self.held = head
+            self.held_range = (start, end)
+            if not self._refine():
+                self.source.data = self.source.from_df(self.held)
+                self._mirror = True
+            return
+
+        held = self.held
+        head, kept, tail = self._stitch(held, head, tail, start, end)
+        forward = head.empty and end >= self.held_range[1]
+        streamable = self._mirror and forward
+        self.held = pd.concat([head, kept, tail])
+        self.held_range = (start, end)
+        if forward and self._view is not None and self._dense():
+            self._stream_view(tail)
+            return
+        if self._refine():
+            return
+        if streamable:
+            # Only the tail changed: rows before start roll over.
+            if len(tail) or len(kept) < len(held):
+                self.source.stream(self.source.from_df(tail),
+                                   rollover=len(self.held))
+        else:
+            self.source.data = self.source.from_df(self.held)
+            self._mirror = True
+
+    def _refresh_view(self):
+        """The downsampled view is kept while it covers the visible range at
+        the same zoom (e.g. when the range moves with the streamed records).
+        """
+        if self._view is not None:
+            start, end = self.visible_range()
+            lower, upper, span = self._view
+            if lower <= start and end <= upper and \
+                    abs(end - start - span) <= TOLERANCE:
+                return
+        self._refine()
+
+    def start_streaming(self, interval):
+        self.stop_streaming()
+        if self.held is None or self.held.empty or \
+                self.held_label is not None:
+            return False
+        self._tail = strm.subscribe(self.mac, self.feature,
+                                    self.held.index[-1], interval, id(self))
+        return True
+
+    def stream_tail(self, start, end):
+        tail = getattr(self, '_tail', None)
+        if tail is None or self.held is None or self.held.empty:
+            return False
+        start, end = _qrange(start, end)
+        if self._resolution(start, end) is not None:
+            return False
+        index = self.held.index
+        x, y, complete = tail.buffer.after(smp._ns(index[-1:])[0])
+        if not complete:
+            return False
+        new = pd.DatetimeIndex(x, name=index.name)
+        if index.tz is not None:
+            new = new.tz_localize('utc').tz_convert(index.tz)
+        rows = pd.DataFrame({self.feature: y}, index=new)
+        self.update_time_range(start, end)
+        self._render((self.start, self.end, None, None, rows, self.held))
+        self._update_gadgets()
+        return True
+
+    def stop_streaming(self):
+        if getattr(self, '_tail', None) is not None:
+            strm.unsubscribe(self.mac, self.feature, id(self))
+            self._tail = None
+
+    def _dense(self):
+        """Whether the held frame has more points than the figure shows."""
+        return self.held is not None and \
+            len(self.held) > smp.POINTS_PER_PIXEL * self.fig.plot_width
+
+    def _refine(self):
+        """Show a downsampled view of the visible range (with a margin of one
+        range on each side for the pans) if the held frame is too dense.
+        Returns whether the source got downsampled data."""
+        if not self._dense():
+            self._view, self._view_x = None, None
+            return False
+        width = self.fig.plot_width
+        start, end = self.visible_range()
+        span = end - start
+        view = _clip(self.held, start - span, end + span)
+        view = smp.downsample(view, 3 * width, mode=self.sampling)
+        self.source.data = self.source.from_df(view)
+        self._mirror = False
+        self._view = (start - span, end + span, span)
+        self._view_x = smp._ns(view.index)
+        return True
+
+    def _stream_view(self, tail):
+        """Stream the tail, downsampled at the resolution of the view, to
+        the source (the rows before the margin of the visible range rolling
+        over), rather than downsampling the held frame again."""
+        start, end = self.visible_range()
+        lower, upper, span = self._view
+        if abs(end - start - span) > TOLERANCE:
+            # The zoom changed: the view is downsampled again
+            self._refine()
+            return
+        self._view = (lower, max(upper, end), span)
+        if tail.empty:
+            return
+        pixel = span / self.fig.plot_width
+        pixels = int(np.ceil((tail.index[-1] - tail.index[0]) / pixel))
+        rows = smp.downsample(tail, max(pixels, 1), mode=self.sampling)
+        x = np.concatenate([self._view_x, smp._ns(rows.index)])
+        self._view_x = x[np.searchsorted(x, (start - span).value):]
+        self._view = (start - span, max(upper, end), span)
+        self.source.stream(self.source.from_df(rows),
+                           rollover=len(self._view_x))
+
 
 class CycleStave(Stave):
     """Class for the events that last."""
+    follow = True
+
     def __init__(self, title, *args, **kwargs):
         super().__init__(title, *args, **kwargs)
         self.init_stave()
@@ -135,92 +501,308 @@ class CycleStave(Stave):
                       left='left', right='right',
                       color='color', source=self.source)
 
-    def _update_fig(self):
-        self.data = sequence(self.mac, self.title, start=self.start,
-                             end=self.end)
+    def _load(self):
+        return sequence(self.mac, self.title, start=self.start, end=self.end)
+
+    def _render(self, loaded):
+        self.data = loaded
         self._plot_fig()
 
+    @mtr.instrumented('stave_plot_fig')
     def _plot_fig(self):
         dg = self.data
         dg = dg.as_digest() if not isinstance(dg, HighlightDigest) else dg
-        dfs = []
-        for i, shade in enumerate(dg.shades()):
-            highlighter = dg.highlighter_type(shade)
-            color = highlighter.plargs.get('color', 'blank')
-            res = [(el.lower, el.upper, shade, color, 0, 1)
-                   for el in dg.highlights(shade)]
-            index = [el[0] for el in res]
-            dfs.append(pd.DataFrame(res, index=index,
-                                    columns=['left', 'right', 'shade',
-                                             'color', 'bottom', 'top']))
-        dfs = list(filter(lambda x: not x.empty, dfs))
-        self.source.data = self.source.from_df(pd.concat(dfs).sort_index())
-
+        self.intervals = ivl.Intervals.from_digest(dg).merged()
+        self._refresh_view()
+
+    def _refresh_view(self):
+        """Coalesce the intervals narrower than a pixel at the current zoom.
+        """
+        intervals = getattr(self, 'intervals', None)
+        if intervals is None:
+            return
+        start, end = self.visible_range()
+        pixel = (end - start).value / self.fig.plot_width
+        self.source.data = intervals.coalesced(pixel).to_source()
+
+
+class ComparisonStave(Stave):
+    """Class to compare a feature between several series, given as (mac,
+    offset, name): each series is shifted forward by its offset (to overlay
+    periods of a device), and resampled with the others on a common grid
+    (the mean over POINTS_PER_PIXEL bins per pixel) of the summary table
+    giving a point per pixel, or of the raw feature. The differences with
+    the first series and the correlations with it (over rolling windows of
+    `window` points) are drawn below the series."""
+    follow = True
+
+    def __init__(self, title, series, *args, **kwargs):
+        self.series = series
+        self.feature = kwargs.setdefault('feature', title)
+        self.window = kwargs.setdefault('window', CORRELATION_WINDOW)
+        super().__init__(title, *args, **kwargs)
+        self.init_stave()
 
-class ComparisonStave(CycleStave):
-    def __init__(self, stave1, stave2):
-        self.title = stave1.title + ' vs ' + stave2.title
+    def _init_fig(self):
+        self.fig.plot_height = 350
+        _kw = {'plot_width': self.fig.plot_width, 'plot_height': 150,
+               'x_axis_type': 'datetime', 'x_range': self.fig.x_range,
+               'tools': 'pan,box_zoom,reset'}
+        reference = self.series[0][2]
+        self.diff_fig = figure(title="Difference with " + reference, **_kw)
+        self.corr_fig = figure(title="Correlation with " + reference,
+                               y_range=Range1d(-1, 1), **_kw)
+        lines = [(fig, column + str(i), Category10[10][i % 10], name)
+                 for i, (mac, offset, name) in enumerate(self.series)
+                 for fig, column in [(self.fig, 's'), (self.diff_fig, 'd'),
+                                     (self.corr_fig, 'c')]
+                 if i or column == 's']
+        self.source = ColumnDataSource(dict(
+            timestamp=[], **{column: [] for fig, column, c, n in lines}))
+        for fig, column, color, name in lines:
+            fig.line('timestamp', column, color=color, legend=name,
+                     source=self.source)
+        for fig in [self.fig, self.diff_fig, self.corr_fig]:
+            fig.legend.location = "top_left"
+            fig.legend.click_policy = "hide"
+        self.plot.children.extend([self.diff_fig, self.corr_fig])
+
+    def _load(self):
+        start, end = _qrange(self.start, self.end)
+        label = resolution_for(start, end, FEATURE_PERIODS,
+                               self.fig.plot_width)
+        n = smp.POINTS_PER_PIXEL * self.fig.plot_width
+        ys = list(COMPARISON_WORKERS.map(
+            lambda s: self._resample(s[0], pd.Timedelta(s[1]), start, end,
+                                     label, n), self.series))
+        grid = start.value + (end - start).value * (np.arange(n) + .5) / n
+        return grid, np.array(ys)
+
+    def _resample(self, mac, offset, start, end, label, n):
+        """The series of a mac, shifted forward by offset, on the grid."""
+        lower, upper = start - offset, end - offset
+        y = None
+        if label is not None:
+            df = sequence(mac, label, start=lower, end=upper).data
+            y = df.get(self.feature + '_mean')
+        if y is None:
+            # Short range, or the feature is not summarized
+            df = sequence(mac, self.feature, start=lower, end=upper).data
+            y = df[self.feature]
+        x = smp._ns(y.index) + offset.value
+        return smp.resample(x, y.values.astype('float64'), start.value,
+                            end.value, n)
+
+    def _render(self, loaded):
+        grid, ys = loaded
+        data = {'timestamp': grid / 1e6, 's0': ys[0]}
+        if len(ys) < 2:
+            self.source.data = data
+            return
+        df = pd.DataFrame(ys.T)
+        corr = df.iloc[:, 1:].rolling(self.window,
+                                      min_periods=self.window // 2) \
+            .corr(df[0])
+        for i in range(1, len(ys)):
+            data['s{}'.format(i)] = ys[i]
+            data['d{}'.format(i)] = ys[i] - ys[0]
+            data['c{}'.format(i)] = corr[i].values
+        self.source.data = data
+        overall = ', '.join('{} {:.2f}'.format(name, c) for (_, _, name), c
+                            in zip(self.series[1:], df.corr()[0].values[1:]))
+        self.corr_fig.title.text = "Correlation with {} ({})".format(
+            self.series[0][2], overall)
 
 
 class AssessmentStave(CycleStave):
     """Class to run and plot assessments."""
+    follow = False
+
     def __init__(self, score, title, *args, **kwargs):
         self.score = score
         super().__init__(title, *args, **kwargs)
 
     def init_stave(self):
+        # The buttons are there before the first assessment
         self._init_fig()
         self.update_time_range(self.start, self.end)
-        self._init_gadgets()
-        self._update_fig()
         self._update_gadgets()
+        if not self.lazy:
+            self._update_fig()
 
     def _init_gadgets(self):
         self._assess = Button(label="Run Condition Assessment")
-        self._assess.on_click(self.update_assessment)
+        self._assess.on_click(self.score._profiled(self.update_assessment,
+                                                   'update_assessment'))
         self._reset = Button(label="Reset Thresholds")
         self._reset.on_click(self.reset_thresholds)
+        self._sweep = Button(label="Sweep Thresholds")
+        self._sweep.on_click(self.update_sweep)
+        self._progress = Div(text='')
+        self._assessing = None
+        self._sweeping = None
+        self._ticking = False
         self.gadgets = [Gadget(self, 'ResetThresholds', tool=self._reset),
-                        Gadget(self, 'ConditionAssessment', tool=self._assess)]
-
-    def _update_fig(self):
+                        Gadget(self, 'ConditionAssessment', tool=self._assess),
+                        Gadget(self, 'SweepThresholds', tool=self._sweep),
+                        Gadget(self, 'Progress', tool=self._progress)]
+        self._init_sweep_table()
+
+    def _init_sweep_table(self):
+        """Table of the sweeps, one row per combination of the factors."""
+        percent = NumberFormatter(format='0.00')
+        columns = [TableColumn(field=feat, title=feat)
+                   for feat in self.score.features]
+        columns += [TableColumn(field=state, title=state + ' (%)',
+                                formatter=percent) for state in ass.STATES]
+        columns.append(TableColumn(field='transitions', title='transitions'))
+        self.sweep_source = ColumnDataSource({c.field: [] for c in columns})
+        self.sweep_table = DataTable(source=self.sweep_source,
+                                     columns=columns, width=1200, height=250)
+        self.plot.children.append(widgetbox(self.sweep_table, width=1200))
+
+    def _load(self):
+        return None
+
+    def _render(self, loaded):
         self.update_assessment()
 
-    def update_assessment(self, *args, **kwargs):
-        dev = env.Device[self.mac]
-        specs = {}
+    def thresholds(self):
+        """Thresholds of the sliders of the feature staves (the ones of the
+        score until the sliders are there)."""
+        res = {}
         for feat in self.score.features:
-            feat_dict = ADict()
             stave = self.score.staves[feat]
-            for i, lev in enumerate(['high', 'med', 'low']):
-                slider = stave.tools.children[i + 1]
-                feat_dict[lev] = slider.value
-            specs[feat] = feat_dict
-        dev.specs['thresholds'].update(specs)
-        assess = cnd.VibrationsConditionAssessment(dev, self.start,
-                                                   self.end)
-        self.data = assess()
+            if stave._gadgets_ready:
+                res[feat] = [stave.tools.children[i + 1].value
+                             for i in range(len(ass.LEVELS))]
+            else:
+                res[feat] = list(self.score.thresholds[feat])
+        return res
+
+    def update_assessment(self, *args, **kwargs):
+        """Run the assessment in the background. It supersedes the one still
+        running, which is cancelled if no other session waits for it."""
+        key = ass.key_for(self.mac, self.start, self.end, self.thresholds())
+        previous = self._assessing
+        if previous is not None and previous[0] == key:
+            return
+        future = ass.submit(key, self)
+        self._assessing = (key, future)
+        if previous is not None:
+            ass.release(previous[0], self)
+        doc = curdoc()
+        if doc.session_context is None:
+            return self._assessed(key, future)
+        self._started = time.time()
+        if not self._ticking:
+            doc.add_periodic_callback(self._tick, 500)
+            self._ticking = True
+        self._tick()
+        future.add_done_callback(lambda f: doc.add_next_tick_callback(
+            partial(self._assessed, key, f)))
+
+    def _tick(self):
+        self._progress.text = "Assessing... ({:.0f}s)".format(
+            time.time() - self._started)
+
+    def _assessed(self, key, future):
+        if self._assessing is None or self._assessing[1] is not future:
+            return
+        self._assessing = None
+        if self._ticking:
+            curdoc().remove_periodic_callback(self._tick)
+            self._ticking = False
+        ass.release(key, self)
+        try:
+            self.data = future.result()
+        except Exception as e:
+            self._progress.text = "Assessment failed: {}".format(e)
+            logging.exception(e)
+            return
+        self._progress.text = ''
         self._plot_fig()
 
+    def update_sweep(self, *args, **kwargs):
+        """Evaluate the thresholds of the sliders scaled by every combination
+        of ass.SWEEP_FACTORS, in the background, over the series held by the
+        feature staves. The staves holding the min/max envelope of a summary
+        (or a preview) are swept over the means of its rows instead."""
+        staves = [self.score.staves[feat] for feat in self.score.features]
+        if any(stave.held is None for stave in staves):
+            self._progress.text = "The features are not loaded yet."
+            return
+        held = [(stave.feature, stave.held, stave.held_label,
+                 stave.held_range) for stave in staves]
+        labels = sorted({label for f, h, label, r in held if label})
+        self._swept_note = "Swept over the means of {}.".format(
+            ', '.join(labels)) if labels else ''
+        thresholds = self.thresholds()
+        self._sweeping = future = WORKERS.submit(
+            lambda: ass.sweep(self._sweep_series(held), thresholds))
+        doc = curdoc()
+        if doc.session_context is None:
+            return self._swept(future)
+        self._progress.text = "Sweeping {} combinations...".format(
+            len(ass.SWEEP_FACTORS) ** len(held))
+        future.add_done_callback(lambda f: doc.add_next_tick_callback(
+            partial(self._swept, f)))
+
+    def _swept(self, future):
+        if self._sweeping is not future:
+            return
+        self._sweeping = None
+        try:
+            res = future.result()
+        except Exception as e:
+            self._progress.text = "Sweep failed: {}".format(e)
+            logging.exception(e)
+            return
+        self._progress.text = self._swept_note
+        self.sweep_source.data = self.sweep_source.from_df(res)
+
+    def _sweep_series(self, held):
+        """The series to sweep, from (feature, held, label, held_range): the
+        held samples, or the means of the summary table they come from."""
+        series = {}
+        for feature, frame, label, (start, end) in held:
+            y = None
+            if label is not None:
+                df = sequence(self.mac, label, start=start, end=end).data
+                y = df.get(feature + '_mean')
+            # Raw samples, or the feature is not summarized
+            series[feature] = frame[feature] if y is None else y
+        return series
+
     def reset_thresholds(self, *args, **kwargs):
         for feat in self.score.features:
             stave = self.score.staves[feat]
+            if not stave._gadgets_ready:
+                continue
             thresholds = self.score.thresholds[feat]
-            for i, lev in enumerate(['high', 'med', 'low']):
+            for i, lev in enumerate(ass.LEVELS):
                 slider = stave.tools.children[i + 1]
                 slider.value = thresholds[i]
 
 
 class PressProdStave(FeatureStave):
+    """The high threshold of the feature is drawn over it (the one of the
+    device specs when not given)."""
     def __init__(self, title, *args, **kwargs):
+        self.threshold = kwargs.setdefault('threshold', None)
         super().__init__(title, *args, **kwargs)
 
     def _init_gadgets(self):
-        threshold = env.Device[self.mac].specs['thresholds'][self.feature].high
+        threshold = self.threshold
+        if threshold is None:
+            threshold = \
+                env.Device[self.mac].specs['thresholds'][self.feature].high
         self.gadgets = [hLine(self, 'threshold', threshold)]
 
 
 class FeatureSummaryStave(FeatureStave):
+    follow = False
+
     def __init__(self, title, *args, **kwargs):
         self.data = kwargs.setdefault('data', None)
         self.data_feat = kwargs.setdefault('data_feat', None)
@@ -256,15 +838,22 @@ class FeatureSummaryStave(FeatureStave):
                 self.fig.line('timestamp', self.feature + '_' + legend,
                               source=self.source_feat)
 
-    def _update_fig(self):
+    def _stages(self):
+        return [self._load]
+
+    def _load(self):
+        if self.score.summary_range.value == 'summary_10s':
+            return sequence(self.score._mac.value, self.feature,
+                            start=self.start, end=self.end)
+
+    def _render(self, loaded):
         assert self.data is not None and self.score is not None
         df = self.data.data[[self.feature + l
                              for l in ['_max', '_mean', '_min']]]
         self.source.data = self.source.from_df(df)
 
         if self.score.summary_range.value == 'summary_10s':
-            self.data_feat = sequence(self.score._mac.value, self.feature,
-                                      start=self.start, end=self.end)
+            self.data_feat = loaded
             df_feat = self.data_feat.data[[self.feature]]
             self.source_feat.data = self.source_feat.from_df(df_feat)
         elif self.data_feat is not None:
@@ -285,7 +874,7 @@ class ConditionStave(FeatureStave):
         self.fig.line('timestamp', self.feature, source=self.source)
 
     def _init_gadgets(self):
-        self.df = self.data.data[self.title]
+        self.df = self.held[self.title]
         slider = Slider(start=int(self.df.min()), end=int(self.df.max()),
                         value=self.df.max() - 2, step=0.1, title="Hull",
                         name=self.title)
@@ -303,6 +892,8 @@ class ConditionStave(FeatureStave):
 
 
 class StackedPercentageStave(CycleStave):
+    follow = False
+
     def __init__(self, title, cc, *args, **kwargs):
         self.data = kwargs.setdefault('data', None)
         self.score = kwargs.setdefault('score', None)
@@ -329,38 +920,32 @@ class StackedPercentageStave(CycleStave):
                                             "right": "datetime"})
         self.fig.add_tools(hoover_tool)
 
-    def _update_fig(self):
+    def _load(self):
+        return None
+
+    def _render(self, loaded):
         assert self.data is not None and self.score is not None
         self._plot_fig()
 
+    @mtr.instrumented('stave_plot_fig')
     def _plot_fig(self):
-        df = self.data.data[[k for k, v in self.cc.items()]]
-        left = df.index
-        right = df.index[1:]
-        right = right.insert(len(right), left[-1] + (left[-1] - left[-2]))
-        df['total'] = df.sum(axis=1)
-        for col in df:
-            df[col] = df.apply(lambda r: 100 * r[col] / r['total'], axis=1)
-        df = df.cumsum(axis=1)
-
-        dfs = []
-        bottom = [0 for el in left]
-        for column, color in self.cc.items():
-            top = df[column]
-            res = pd.DataFrame({'left': left, 'right': right,
-                                'bottom': bottom, 'top': top})
-            res['color'] = color
-            res['legend'] = column.split('_')[-1]
-            res['percent'] = res['top'] - res['bottom']
-            bottom = top
-            dfs.append(res)
-        self.source.data = self.source.from_df(pd.concat(dfs).sort_index())
+        df = self.data.data
+        left, right = qd.edges(df.index)
+        self.source.data = qd.stack(
+            df[list(self.cc)].values, left, right, list(self.cc.values()),
+            [column.split('_')[-1] for column in self.cc])
 
 
 class HeatMapStave(CycleStave):
+    """Counts of a summary table column, or of the records of a raw log
+    re-binned at `bins` (a bin width) when given."""
+    follow = False
+
     def __init__(self, title, *args, **kwargs):
         self.data = kwargs.setdefault('data', None)
         self.score = kwargs.setdefault('score', None)
+        self.bins = kwargs.setdefault('bins', None)
+        self.log = kwargs.setdefault('log', 'stroke')
         super().__init__(title, *args, **kwargs)
 
     def _init_fig(self):
@@ -382,24 +967,19 @@ class HeatMapStave(CycleStave):
                                             "right": "datetime"})
         self.fig.add_tools(hoover_tool)
 
-    def _update_fig(self):
-        assert self.data is not None and self.score is not None
-        self._plot_fig()
+    def _load(self):
+        if self.bins is not None:
+            return sequence(self.mac, self.log, start=self.start,
+                            end=self.end)
 
-    def _plot_fig(self):
-        df = self.data.data[[self.title]]
-        df.columns = ['count']
-        df['percent'] = 100 * df / ((1 + df.max()) * len(PALETTE))
-        df = df.astype(int)
-        df['color'] = df['percent'].map(lambda x: PALETTE[x])
-        df['left'] = df.index
-        df['right'] = df['left'].shift(-1)
-        df['right'].fillna(df.index[-1] + (df.index[-1] - df.index[-2]),
-                           inplace=True)
-        df['bottom'] = 0
-        df['top'] = 1
-        df['x'] = df['left'] + (df['right'] - df['left']) / 2
-        df['y'] = 0.5
-        df['text'] = df['count'].map(str)
-        df.loc[df.text == '0', 'text'] = ''
-        self.source.data = self.source.from_df(df)
+    def _render(self, loaded):
+        assert self.data is not None and self.score is not None
+        if loaded is None:
+            df = self.data.data
+            left, right = qd.edges(df.index)
+            counts = df[self.title].values
+        else:
+            start, end = _qrange(self.start, self.end)
+            left, right, counts = qd.rebin(loaded.data.index, start, end,
+                                           self.bins)
+        self.source.data = qd.heat(counts, left, right, PALETTE)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tailing of the latest records of the devices, shared by all the sessions
+streaming the same (mac, label).
+"""
+# ===================================================================
+# Imports
+# ===================================================================
+
+import os
+import time
+from threading import Lock, Thread
+
+import numpy as np
+import pandas as pd
+
+from tzigane import LOGGER
+from tzigane.sampling import _ns
+from tzigane.util import sequence
+
+# Number of rows kept by each ring buffer.
+CAPACITY = int(os.environ.get('TZIGANE_STREAM_CAPACITY', 100000))
+# Shortest interval (in seconds) between two polls of a device.
+MIN_INTERVAL = 0.2
+
+TAILS = {}
+_LOCK = Lock()
+
+# ===================================================================
+# Class definitions
+# ===================================================================
+
+
+class RingBuffer:
+    """Fixed-size buffer of the last rows of a series. It holds every row
+    after `origin` (timestamps in ns), until the first ones roll over."""
+    def __init__(self, origin, capacity=CAPACITY):
+        self.origin, self.capacity = origin, capacity
+        self.x = np.zeros(capacity, dtype='int64')
+        self.y = np.zeros(capacity, dtype='float64')
+        self.count = 0
+        self._lock = Lock()
+
+    def append(self, x, y):
+        x, y = x[-self.capacity:], y[-self.capacity:]
+        with self._lock:
+            pos = (self.count + np.arange(len(x))) % self.capacity
+            self.x[pos], self.y[pos] = x, y
+            self.count += len(x)
+
+    def after(self, ts):
+        """Rows with a timestamp after ts, and whether the buffer reaches back
+        to ts (i.e. no row after ts is missing)."""
+        with self._lock:
+            n = min(self.count, self.capacity)
+            pos = (self.count - n + np.arange(n)) % self.capacity
+            x, y = self.x[pos], self.y[pos]
+        covered = self.origin if self.count <= self.capacity else x[0]
+        i = np.searchsorted(x, ts, side='right')
+        return x[i:], y[i:], ts >= covered
+
+
+class Tail:
+    """Polls the records of a (mac, label) newer than the last one, at the
+    shortest interval wanted by its subscribers, into a ring buffer. The
+    thread stops with the last subscriber."""
+    def __init__(self, mac, label, since):
+        self.mac, self.label = mac, label
+        self.last = since
+        self.buffer = RingBuffer(_ns(pd.DatetimeIndex([since]))[0])
+        self.intervals = {}
+        self.thread = Thread(target=self._run, daemon=True)
+
+    @property
+    def alive(self):
+        return self.thread.is_alive()
+
+    def poll(self):
+        frame = sequence(self.mac, self.label, start=self.last,
+                         end=pd.Timestamp('now', tz='utc'), cache=False)
+        df = frame.data[[self.label]]
+        df = df[df.index > self.last]
+        if not df.empty:
+            self.buffer.append(_ns(df.index),
+                               df[self.label].values.astype('float64'))
+            self.last = df.index[-1]
+
+    def _run(self):
+        while True:
+            with _LOCK:
+                if not self.intervals:
+                    TAILS.pop((self.mac, self.label), None)
+                    return
+                interval = max(MIN_INTERVAL, min(self.intervals.values()))
+            start = time.time()
+            try:
+                self.poll()
+            except Exception as e:
+                LOGGER.warning("Cannot tail {} of {}: {}".format(
+                    self.label, self.mac, e))
+            time.sleep(max(0, interval - (time.time() - start)))
+
+
+# ===================================================================
+# Helper function
+# ===================================================================
+
+
+def subscribe(mac, label, since, interval, key):
+    """Helper function that returns the running tail of (mac, label), or
+    starts one from the timestamp `since`."""
+    with _LOCK:
+        tail = TAILS.get((mac, label))
+        if tail is None:
+            tail = TAILS[(mac, label)] = Tail(mac, label, since)
+        tail.intervals[key] = interval
+    if not tail.alive:
+        try:
+            tail.thread.start()
+        except RuntimeError:
+            # Started by another subscriber in the meantime
+            pass
+    return tail
+
+
+def unsubscribe(mac, label, key):
+    with _LOCK:
+        tail = TAILS.get((mac, label))
+        if tail is not None:
+            tail.intervals.pop(key, None)
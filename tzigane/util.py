@@ -1,6 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import os
+import copy
+import time
+import pickle
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
+from bokeh.io import curdoc
 
 from anaximander.utilities.nxtime import datetime, now
 from anaximander.data import DataTract
@@ -15,6 +26,11 @@ from dataforge.pressproduction import PressProdTransitionLogs, StrokeCountLogs
 from dataforge.devicestatus import DeviceStatusIOError
 import dataforge.summary as smr
 
+import tzigane.metrics as mtr
+from tzigane import LOGGER
+from tzigane.sources import DataSource, ParquetSource
+from tzigane.sources import RecordingSource, ReplaySource
+
 
 TABLE = {'summary_10s': smr.FeatureSummary10s,
          'summary_1m': smr.FeatureSummary1m,
@@ -47,6 +63,79 @@ TABLE = {'summary_10s': smr.FeatureSummary10s,
          'pressprod': PressProdTransitionLogs,
          'stroke': StrokeCountLogs}
 
+# Width of the aligned time tiles used to cache each label. The coarser the
+# table, the wider the tile, so that a tile holds a comparable number of rows.
+TILE = {'summary_10s': '6h',
+        'summary_1m': '1D',
+        'summary_5m': '7D',
+        'summary_30m': '30D',
+        'summary_6H': '180D',
+        'summary_1D': '720D',
+        'summary_7D': '3600D',
+        'MetricSummary5m': '7D',
+        'MetricSummary30m': '30D',
+        'MetricSummaryS1': '30D',
+        'MetricSummaryS2': '30D',
+        'MetricSummaryS3': '30D',
+        'MetricSummary1D': '720D',
+        'MetricSummary1M': '3600D',
+        'latency': '1h',
+        'activity': '1D',
+        'condition': '1D',
+        'connectivity': '1D',
+        'pressprod': '1D',
+        'stroke': '1D'}
+DEFAULT_TILE = '15min'
+
+# Period of the rows of the summary tables, from the finest to the coarsest.
+FEATURE_PERIODS = [('summary_10s', '10s'),
+                   ('summary_1m', '1min'),
+                   ('summary_5m', '5min'),
+                   ('summary_30m', '30min'),
+                   ('summary_6H', '6h'),
+                   ('summary_1D', '1D'),
+                   ('summary_7D', '7D')]
+METRIC_PERIODS = [('MetricSummary5m', '5min'),
+                  ('MetricSummary30m', '30min'),
+                  ('MetricSummary1D', '1D'),
+                  ('MetricSummary1M', '30D')]
+
+# Cache configuration, overridable from the environment.
+CACHE_BYTES = int(os.environ.get('TZIGANE_CACHE_BYTES', 512 * 2 ** 20))
+CACHE_DIR = os.environ.get('TZIGANE_CACHE_DIR')
+CACHE_DIR_BYTES = int(os.environ.get('TZIGANE_CACHE_DIR_BYTES', 2 * 2 ** 30))
+# Tiles overlapping "now" (or the latest status of a state table) are still
+# being written by the devices: they are only kept for OPEN_TTL seconds.
+OPEN_TTL = float(os.environ.get('TZIGANE_CACHE_OPEN_TTL', 30))
+CLOSED_TTL = float(os.environ.get('TZIGANE_CACHE_CLOSED_TTL', 24 * 3600))
+
+# Directory of Parquet files served instead of the dataforge backend (see
+# tzigane.sources).
+PARQUET_DIR = os.environ.get('TZIGANE_PARQUET_DIR')
+# Archive the backend queries are recorded to, or replayed from (with the
+# recorded latencies multiplied by TZIGANE_REPLAY_LATENCY).
+RECORD_DIR = os.environ.get('TZIGANE_RECORD')
+REPLAY_DIR = os.environ.get('TZIGANE_REPLAY')
+REPLAY_LATENCY = float(os.environ.get('TZIGANE_REPLAY_LATENCY', 0))
+# Pinned current time (e.g. '2017-10-01 12:00'), from which the default
+# ranges are computed. Recordings pin the time they start at (unless it is
+# pinned already), and replays the one of their recording.
+NOW = os.environ.get('TZIGANE_NOW')
+
+# Bounded pool running the backend queries concurrently.
+WORKERS = ThreadPoolExecutor(int(os.environ.get('TZIGANE_WORKERS', 8)))
+
+
+def _now():
+    """Helper function that returns the current (or pinned) time."""
+    return pd.Timestamp("now", tz='utc') if NOW is None else _utc(NOW)
+
+
+def set_now(ts=None):
+    """Pin the current time (None to unpin it)."""
+    global NOW
+    NOW = ts
+
 
 def _qrange(start=None, end=None, duration=None, res="ts"):
     """Helper function to retrieve the timestamp (or string) for start/end."""
@@ -61,7 +150,7 @@ def _qrange(start=None, end=None, duration=None, res="ts"):
             except Exception as e:
                 pass
     except AssertionError as e:
-        end = pd.Timestamp("now", tz='utc')
+        end = _now()
 
     try:
         start = pd.Timestamp(start, tz='utc')
@@ -88,68 +177,451 @@ def _qrange(start=None, end=None, duration=None, res="ts"):
                 end.strftime('%Y-%m-%d %H:%M:%S'))
 
 
+class Debounce:
+    """Calls func once the calls stopped for `delay` milliseconds, e.g. at the
+    end of a pan. Out of a session, func is called right away."""
+    def __init__(self, func, delay=300):
+        self.func, self.delay = func, delay
+        self._token = 0
+
+    def __call__(self, *args, **kwargs):
+        doc = curdoc()
+        if doc.session_context is None:
+            return self.func(*args, **kwargs)
+        self._token += 1
+        doc.add_timeout_callback(partial(self._run, self._token, args, kwargs),
+                                 self.delay)
+
+    def _run(self, token, args, kwargs):
+        if token == self._token:
+            self.func(*args, **kwargs)
+
+
+def resolution_for(start, end, periods, points):
+    """Helper function that picks the coarsest summary table giving at least
+    `points` rows over [start, end] (None if even the finest does not)."""
+    duration = pd.Timestamp(end) - pd.Timestamp(start)
+    res = None
+    for label, period in periods:
+        if duration / pd.Timedelta(period) >= points:
+            res = label
+    return res
+
+
+def _is_state(label):
+    """Whether the label is read from a state (transition logs) table."""
+    table = TABLE[label]
+    table = table.bigtable if isinstance(table, DataTract) else table
+    table_cols = [j for i in [el for el in table.columns.values()] for j in i]
+    return label not in table_cols and 'states' in table.columns.keys()
+
+
+def _tiles(label, start, end):
+    """Helper function that splits [start, end] into aligned time tiles."""
+    width = pd.Timedelta(TILE.get(label, DEFAULT_TILE))
+    lower = start.floor(width)
+    tiles = []
+    while lower < end:
+        tiles.append((lower, lower + width))
+        lower += width
+    return tiles or [(lower, lower + width)]
+
+
+def _utc(ts):
+    """Helper function that returns a utc timestamp, whatever the input."""
+    ts = pd.Timestamp(ts)
+    return ts.tz_localize('utc') if ts.tz is None else ts.tz_convert('utc')
+
+
+def _clip(df, start, end, closed=True):
+    """Helper function that restricts a timestamp-indexed frame to a range
+    (closed or right-open)."""
+    index = df.index
+    if getattr(index, 'tz', None) is None:
+        start, end = start.tz_convert(None), end.tz_convert(None)
+    upper = (index <= end) if closed else (index < end)
+    return df[(index >= start) & upper]
+
+
+def _clip_state(df, start, end):
+    """Helper function that restricts a transition log to [start, end],
+    along with its last row at or before start (the state in effect at
+    start)."""
+    index = df.index
+    if getattr(index, 'tz', None) is None:
+        start, end = start.tz_convert(None), end.tz_convert(None)
+    first = max(index.searchsorted(start, side='right') - 1, 0)
+    return df.iloc[first:index.searchsorted(end, side='right')]
+
+
+def _nbytes(frame):
+    """Estimate of the memory held by a frame, used for the byte budget."""
+    try:
+        return int(frame.data.memory_usage(deep=True).sum())
+    except Exception:
+        return 1024
+
+
+def _merge(frames, start, end, closed=True, state=False):
+    """Helper function that stitches frames into one frame restricted to
+    [start, end] (used both to cut a query into tiles and to join them).
+    The transition logs (state=True) keep the state in effect at start."""
+    frame = copy.copy(frames[0])
+    data = pd.concat([f.data for f in frames]) if len(frames) > 1 \
+        else frames[0].data
+    frame.data = _clip_state(data, start, end) if state \
+        else _clip(data, start, end, closed=closed)
+    try:
+        # The copy is shallow: the keyrange of the cached frame is kept.
+        frame.keyrange = copy.deepcopy(frames[0].keyrange)
+        frame.keyrange['timestamp'] = time_interval(start, end)
+    except Exception:
+        pass
+    return frame
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache bounded by a budget in bytes."""
+    def __init__(self, max_bytes, stats=None):
+        self.max_bytes = max_bytes
+        self.stats = Counter() if stats is None else stats
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, size, expires = self._items[key]
+            except KeyError:
+                return None
+            if expires is not None and expires < time.time():
+                self._pop(key)
+                self.stats['expirations'] += 1
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value, ttl=None, size=1):
+        if size > self.max_bytes:
+            return
+        expires = None if ttl is None else time.time() + ttl
+        with self._lock:
+            if key in self._items:
+                self._pop(key)
+            self._items[key] = (value, size, expires)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                self._pop(next(iter(self._items)))
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+    def _pop(self, key):
+        value, size, expires = self._items.pop(key)
+        self.nbytes -= size
+
+
+class DiskCache:
+    """On-disk tier of the cache. Files are written atomically, so that a
+    directory in shared memory (e.g. /dev/shm) can be shared by several
+    worker processes. It is pruned, oldest files first, beyond max_bytes."""
+    def __init__(self, path, max_bytes=None, stats=None):
+        self.path, self.max_bytes = path, max_bytes
+        self.stats = Counter() if stats is None else stats
+        self._puts = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def _file(self, key):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.path, name + '.pkl')
+
+    def get(self, key):
+        """The value along with the time it expires (None if it does not)."""
+        try:
+            with open(self._file(key), 'rb') as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None, None
+        if expires is not None and expires < time.time():
+            self.stats['expirations'] += 1
+            return None, None
+        return value, expires
+
+    def put(self, key, value, ttl=None):
+        expires = None if ttl is None else time.time() + ttl
+        tmp = self._file(key) + '.{}.{}.tmp'.format(os.getpid(),
+                                                    threading.get_ident())
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump((expires, value), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._file(key))
+        except Exception as e:
+            LOGGER.warning("Cannot write cache tile: {}".format(e))
+        self._puts += 1
+        if self.max_bytes is not None and self._puts % 100 == 0:
+            self.prune()
+
+    def prune(self):
+        """Remove the oldest files until the directory fits in max_bytes."""
+        files = []
+        for entry in os.scandir(self.path):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for mtime, size, path in files)
+        for mtime, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.stats['disk_evictions'] += 1
+
+
+class SequenceCache:
+    """Tiered cache for sequence(): an in-process LRU in front of an optional
+    on-disk tier (possibly shared between processes). Data tables are cached
+    per aligned time tile, so that panning only fetches the tiles that are
+    not known yet. State tables are cached over the whole tile-aligned span,
+    as a transition log depends on what precedes the window, and restricted
+    to the requested range (up to the latest update, from the state in
+    effect at its start) when they are read."""
+    def __init__(self, max_bytes=CACHE_BYTES, path=CACHE_DIR,
+                 disk_bytes=CACHE_DIR_BYTES):
+        self.counts = Counter()
+        self.memory = LRUCache(max_bytes, stats=self.counts)
+        self.disk = DiskCache(path, disk_bytes, stats=self.counts) \
+            if path else None
+
+    def stats(self):
+        """Hit/miss/eviction counters, along with the memory footprint."""
+        res = dict(self.counts)
+        res.update({'tiles': len(self.memory), 'bytes': self.memory.nbytes})
+        return res
+
+    def clear(self):
+        self.memory.clear()
+
+    def _get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            self.counts['hits'] += 1
+            return value
+        if self.disk is not None:
+            value, expires = self.disk.get(key)
+            if value is not None:
+                self.counts['disk_hits'] += 1
+                ttl = None if expires is None else expires - time.time()
+                self.memory.put(key, value, ttl, _nbytes(value[0]))
+                return value
+        self.counts['misses'] += 1
+        return None
+
+    def _put(self, key, value, is_open):
+        ttl = OPEN_TTL if is_open else CLOSED_TTL
+        self.memory.put(key, value, ttl, _nbytes(value[0]))
+        if self.disk is not None:
+            self.disk.put(key, value, ttl)
+
+    def sequence(self, mac, label, start, end, check_status=True):
+        if _is_state(label):
+            tiles = _tiles(label, start, end)
+            lower, upper = tiles[0][0], tiles[-1][1]
+            key = (mac, label, lower, upper, check_status)
+            value = self._get(key)
+            if value is None:
+                value = _fetch(mac, label, lower, upper,
+                               check_status=check_status)
+                self._put(key, value, is_open=upper > value[1])
+            frame, cutoff = value
+            if start >= cutoff:
+                msg = "Cannot provide state sequence from {0} to {1}, " + \
+                    "which is beyond the latest update {2}."
+                raise DeviceStatusIOError(msg.format(start, end, cutoff))
+            return _merge([frame], start, min(end, cutoff), state=True)
+
+        tiles = _tiles(label, start, end)
+        values = [self._get((mac, label) + tile) for tile in tiles]
+        missing = [i for i, value in enumerate(values) if value is None]
+        # Consecutive missing tiles are fetched with a single query (but for
+        # the recordings and their replays, which must query the same tiles
+        # whatever the cache holds).
+        runs = []
+        for i in missing:
+            if runs and runs[-1][-1] == i - 1 and not SOURCE.per_tile:
+                runs[-1].append(i)
+            else:
+                runs.append([i])
+        for run in runs:
+            lower, upper = tiles[run[0]][0], tiles[run[-1]][1]
+            frame, complete = _fetch(mac, label, lower, upper)
+            for i in run:
+                tile = _merge([frame], *tiles[i], closed=False)
+                values[i] = (tile, complete)
+                self._put((mac, label) + tiles[i], values[i],
+                          is_open=tiles[i][1] > complete)
+        return _merge([value[0] for value in values], start, end)
+
+
+CACHE = SequenceCache()
+
+
+class DataforgeSource(DataSource):
+    """Backend querying the dataforge tables (see TABLE) and accounts."""
+    name = 'dataforge'
+
+    def fetch(self, mac, label, start, end, maxrows=None, maxraise=None,
+              check_status=True):
+        device = env.Device[mac]
+        table = TABLE[label]
+        table = table.bigtable if isinstance(table, DataTract) else table
+
+        table_cols = [j for i in [el for el in table.columns.values()]
+                      for j in i]
+
+        if label in table_cols:
+            q = table.query(label, mac=mac, timestamp=(start, end))
+            frame = q.sequence(context=device, maxrows=maxrows,
+                               maxraise=maxraise)
+        elif 'states' in table.columns.keys():
+            query = table.query(mac=mac, timestamp=(start, end))
+            frame = query.sequence(context=device, maxrows=maxrows,
+                                   maxraise=maxraise)
+            cutoff = None
+            if check_status:
+                try:
+                    status_type = type(device.get_status(label))
+                    assert status_type.logs.bigtable is not None
+                except (KeyError, AttributeError, AssertionError):
+                    # This is ignored for convenience
+                    pass
+                else:
+                    latest_status = status_type.recall(device, when=end)
+                    cutoff = latest_status.certificate.timestamp
+            if cutoff is None:
+                if end is None:
+                    cutoff = now()
+                else:
+                    cutoff = datetime(end)
+            cutoff = _utc(cutoff)
+
+            if end > cutoff and start < cutoff:
+                frame.keyrange['timestamp'] = time_interval(start, cutoff)
+            elif start >= cutoff:
+                msg = "Cannot provide state sequence from {0} to {1}, " + \
+                    "which is beyond the latest update {2}."
+                raise DeviceStatusIOError(msg.format(start, end, cutoff))
+
+            if not frame.empty:
+                return frame, cutoff
+
+            q_prev = table.query(mac=mac, timestamp=(None, end))
+            try:
+                prev = q_prev.first()
+            except Exception as e:
+                print(e)
+            else:
+                frame.unique = prev.next_state
+            return frame, cutoff
+        else:
+            q = table.query(mac=mac, timestamp=(start, end))
+            frame = q.sequence(context=device, maxrows=maxrows,
+                               maxraise=maxraise)
+        return frame, pd.Timestamp("now", tz='utc')
+
+    def devices(self):
+        accounts = env.Account.requery_all()
+        records = []
+        for acc in accounts:
+            for d in acc.devices():
+                # Needed for condition. Accounts are empty
+                dev = env.Device[d.mac]
+                records.append({'mac': dev.mac,
+                                'device': str(dev),
+                                'account': dev.account.name,
+                                'function': dev.function})
+        return records
+
+
+def _source():
+    """Helper function that returns the backend set up by the environment."""
+    if REPLAY_DIR:
+        source = ReplaySource(REPLAY_DIR, REPLAY_LATENCY)
+        if NOW is None:
+            set_now(source.now)
+        return source
+    source = ParquetSource(PARQUET_DIR) if PARQUET_DIR else DataforgeSource()
+    if not RECORD_DIR:
+        return source
+    # The ranges of a recording are computed from a pinned time, the one
+    # its replays pin.
+    if NOW is None:
+        set_now(pd.Timestamp("now", tz='utc').floor('s'))
+    return RecordingSource(source, RECORD_DIR, now=_now())
+
+
+SOURCE = _source()
+
+
+def set_source(source):
+    """Serve sequence() and the inventory from another backend (the cached
+    tiles of the previous one are dropped)."""
+    global SOURCE
+    SOURCE = source
+    CACHE.clear()
+    if CACHE.disk is not None:
+        LOGGER.warning("The on-disk cache is shared by all the sources.")
+
+
+def _fetch(mac, label, start, end, maxrows=None, maxraise=None,
+           check_status=True):
+    """Helper function that queries the backend.
+    Output:
+        the frame along with the time up to which it is complete."""
+    with mtr.Timer('backend_query', label=label, source=SOURCE.name) as t:
+        frame, complete = SOURCE.fetch(mac, label, start, end,
+                                       maxrows=maxrows, maxraise=maxraise,
+                                       check_status=check_status)
+        t.rows, t.nbytes = len(frame.data), _nbytes(frame)
+    mtr.slow_query(t.seconds, "{} of {} from {} to {}, {} rows".format(
+        label, mac, start, end, t.rows))
+    return frame, complete
+
+
 def sequence(mac, label, start=None, end=None, duration=None, maxrows=None,
-             maxraise=None, check_status=True):
+             maxraise=None, check_status=True, cache=True):
     """Helper function that retrieves the data corresponding to the label.
     Input:
         - device: can be either the device object or the mac of the device,
         - label: cf. table above.
         - columns: to specify the columns wanted from the data.
+        - cache: whether to go through the tiered cache (bypassed anyway
+          when maxrows or maxraise are given).
     Output:
         the corresponding dataframe.
     """
     if not isinstance(mac, str):
         mac = mac.mac
-    device = env.Device[mac]
 
     start, end = _qrange(start, end, duration)
-    table = TABLE[label]
-    table = table.bigtable if isinstance(table, DataTract) else table
-
-    table_cols = [j for i in [el for el in table.columns.values()] for j in i]
-
-    if label in table_cols:
-        q = table.query(label, mac=mac, timestamp=(start, end))
-        frame = q.sequence(context=device, maxrows=maxrows, maxraise=maxraise)
-    elif 'states' in table.columns.keys():
-        query = table.query(mac=mac, timestamp=(start, end))
-        frame = query.sequence(context=device, maxrows=maxrows,
-                               maxraise=maxraise)
-        cutoff = None
-        if check_status:
-            try:
-                status_type = type(device.get_status(label))
-                assert status_type.logs.bigtable is not None
-            except (KeyError, AttributeError, AssertionError):
-                # This is ignored for convenience
-                pass
-            else:
-                latest_status = status_type.recall(device, when=end)
-                cutoff = latest_status.certificate.timestamp
-        if cutoff is None:
-            if end is None:
-                cutoff = now()
-            else:
-                cutoff = datetime(end)
-
-        if end > cutoff and start < cutoff:
-            frame.keyrange['timestamp'] = time_interval(start, cutoff)
-        elif start >= cutoff:
-            msg = "Cannot provide state sequence from {0} to {1}, " + \
-                "which is beyond the latest update {2}."
-            raise DeviceStatusIOError(msg.format(start, end, cutoff))
-
-        if not frame.empty:
-            return frame
-
-        q_prev = table.query(mac=mac, timestamp=(None, end))
-        try:
-            prev = q_prev.first()
-        except Exception as e:
-            print(e)
+    with mtr.Timer('sequence', label=label) as t:
+        if cache and maxrows is None and maxraise is None:
+            frame = CACHE.sequence(mac, label, start, end,
+                                   check_status=check_status)
         else:
-            frame.unique = prev.next_state
-    else:
-        q = table.query(mac=mac, timestamp=(start, end))
-        frame = q.sequence(context=device, maxrows=maxrows, maxraise=maxraise)
+            frame, cutoff = _fetch(mac, label, start, end, maxrows=maxrows,
+                                   maxraise=maxraise,
+                                   check_status=check_status)
+        t.rows = len(frame.data)
     return frame